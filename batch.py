@@ -0,0 +1,524 @@
+# %%
+import ast
+import heapq
+import operator
+from collections.abc import MutableMapping
+from copy import deepcopy
+from typing import Any, Callable, Iterator, Mapping, Optional, Sequence, Union
+from tokens import InstructionType as IType, EventType as E, Event
+from bytecode import ChunkError, resolve_labels
+from exprs import GLOBALS, evaluator
+from store import IMMUTABLE_TYPES
+from symbols import assign
+from vm import VMState, UNSET
+
+try:
+    import numpy as np
+except ImportError:  # Optional: only batch mode needs numpy
+    np = None
+
+READY, RUNNING, SUSPENDED, HALTED = VMState
+
+# Batch mode runs many sessions of one script with their variables stored as
+# NumPy columns (struct of arrays). Sessions parked at the same instruction
+# form a Group and advance together; a condition is evaluated once per group
+# as a vectorized NumPy operation, and the group splits where it diverges.
+# Expressions outside the vectorizable subset run per session against a row
+# view of the columns.
+#
+# Batch mode keeps variables in its columns by name, so it runs chunks from
+# Compiler() and optimize(), not slot-resolved ones from Compiler(slots=True);
+# their slot instructions raise ChunkError when the Batch is built.
+
+VECTOR_COMPARE = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge
+}
+
+# Column dtype kind for each scalar type that gets a typed column
+KINDS = {bool: 'b', int: 'i', float: 'f'}
+DTYPES = {'b': 'bool', 'i': 'int64', 'f': 'float64', None: 'object'}
+
+Vector = Callable[['Batch', Any], Any]
+
+
+def _truth(value, n: int):
+    # Boolean mask of length n from a vector, an object array or a scalar
+    if np.ndim(value) == 0:
+        return np.full(n, bool(value))
+    if value.dtype == bool:
+        return value
+    if value.dtype == object:
+        return np.fromiter(map(bool, value), bool, len(value))
+    return value != 0
+
+
+def _py(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _vector(node: ast.AST, truth: bool) -> Vector:
+    # fn(batch, members) -> array or scalar. Boolean operators are only
+    # vectorized where just the truth of the result is used, since they
+    # reduce to masks rather than Python's operand-returning semantics.
+    # Raises TypeError outside the supported subset.
+    if isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float, str, type(None))):
+        value = node.value
+        return lambda b, members: value
+
+    if isinstance(node, ast.Name):
+        name = node.id
+        return lambda b, members: b.load(name, members)
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        operand = _vector(node.operand, False)
+        return lambda b, members: np.negative(operand(b, members))
+
+    if isinstance(node, ast.Compare) and all(type(op) in VECTOR_COMPARE for op in node.ops):
+        operands = [_vector(n, False) for n in (node.left, *node.comparators)]
+        ops = [VECTOR_COMPARE[type(op)] for op in node.ops]
+
+        def compare(b, members):
+            values = [fn(b, members) for fn in operands]
+            mask = ops[0](values[0], values[1])
+            for op, lhs, rhs in zip(ops[1:], values[1:], values[2:]):
+                mask = mask & op(lhs, rhs)
+            return mask
+
+        return compare
+
+    if truth and isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        operand = _vector(node.operand, True)
+        return lambda b, members: ~_truth(operand(b, members), len(members))
+
+    if truth and isinstance(node, ast.BoolOp):
+        values = [_vector(v, True) for v in node.values]
+        combine = operator.and_ if isinstance(node.op, ast.And) else operator.or_
+
+        def boolop(b, members):
+            mask = _truth(values[0](b, members), len(members))
+            for value in values[1:]:
+                mask = combine(mask, _truth(value(b, members), len(members)))
+            return mask
+
+        return boolop
+
+    raise TypeError(f'unsupported expression node {type(node).__name__}')
+
+
+def vectorize(src: str, truth: bool = False) -> Optional[Vector]:
+    try:
+        return _vector(ast.parse(src.strip(), mode='eval').body, truth)
+    except (SyntaxError, TypeError):
+        return None
+
+
+class Row(MutableMapping):
+    # One session's variables, read from and written to the batch columns;
+    # the namespace for expressions and code that cannot be vectorized
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch: 'Batch', index: int) -> None:
+        self.batch = batch
+        self.index = index
+
+    def __getitem__(self, name: str):
+        value = self.batch.columns[name][self.index]
+        if value is UNSET:
+            raise KeyError(name)
+        return _py(value)
+
+    def __setitem__(self, name: str, value):
+        self.batch.assign(name, self.index, value)
+
+    def __delitem__(self, name: str):
+        if name not in self:
+            raise KeyError(name)
+        self.batch.assign(name, self.index, UNSET)
+
+    def __iter__(self) -> Iterator[str]:
+        return (name for name in self.batch.columns if name in self)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class Group:
+    # Sessions at the same ip. `stack` holds one entry per pushed value:
+    # an array aligned with members, or a scalar shared by all of them.
+    __slots__ = ('ip', 'members', 'state', 'stack', 'options', 'render')
+
+    def __init__(self, ip: int, members, stack: list = None, options: list = None) -> None:
+        self.ip = ip
+        self.members = members
+        self.state: VMState = READY
+        self.stack: list = stack if stack is not None else []
+        # (texts, valid mask, target) for each option of the pending choice
+        self.options: list = options if options is not None else []
+        self.render: Callable[[], list[Event]] = lambda: [Event(E.END)] * len(self.members)
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def split(self, mask) -> tuple['Group', 'Group']:
+        def take(m):
+            return [value[m] if np.ndim(value) else value for value in self.stack]
+
+        return Group(self.ip, self.members[mask], take(mask)), Group(self.ip, self.members[~mask], take(~mask))
+
+    def events(self) -> list[Event]:
+        # Rendered on request, so lines nobody reads cost nothing; call
+        # before resuming the group
+        return self.render()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(ip={self.ip}, sessions={len(self)}, state={self.state.name})'
+
+
+class Batch:
+
+    def __init__(self, chunk: Sequence[tuple[IType, tuple]], size: int, defaults: Mapping[str, Any] = None) -> None:
+        if np is None:
+            raise ImportError('Batch mode requires numpy')
+
+        self.chunk = [(itype, tuple(args)) for itype, args in chunk]
+        self.labels = resolve_labels(self.chunk)
+        self.size = size
+
+        self.columns: dict[str, Any] = {}
+        # Columns holding UNSET for some sessions
+        self.partial: set[str] = set()
+        for name, value in (defaults or {}).items():
+            self.columns[name] = self._column(value)
+
+        self.groups: list[Group] = [Group(0, np.arange(size))]
+        self.steps = 0
+
+        self.cmds = {
+            IType.OP_EXPR: self.expr,
+            IType.OP_JUMP_FALSE: self.jump_if_false,
+            IType.OP_EXPR_JUMP_FALSE: self.expr_jump_if_false,
+            IType.OP_JUMP: self.jump,
+            IType.EXEC_GOTO: self.goto,
+            IType.LABEL: self.label,
+            IType.EXEC_CODE: self.code,
+            IType.EXEC_LINE: self.line,
+            IType.EXEC_EXPR_LINE: self.expr_line,
+            IType.EXEC_TAGS: self.tags,
+            IType.ADD_OPTION: self.add_option,
+            IType.EXEC_OPTIONS: self.exec_options
+        }
+
+        for i, (itype, _) in enumerate(self.chunk):
+            if itype not in self.cmds:
+                raise ChunkError(f'{itype.name} at {i} is not supported in batch mode; '
+                                 'compile without slots')
+
+        # Vectorized form of each expression argument, built on first use
+        self._vectors: dict[tuple[str, bool], Optional[Vector]] = {}
+
+    def _column(self, value):
+        kind = KINDS.get(type(value))
+        if kind is not None:
+            try:
+                return np.full(self.size, value, dtype=DTYPES[kind])
+            except OverflowError:
+                pass
+
+        column = np.empty(self.size, dtype=object)
+        if isinstance(value, IMMUTABLE_TYPES):
+            column.fill(value)
+        else:
+            column[:] = [deepcopy(value) for _ in range(self.size)]
+        return column
+
+    # ========================= Variables
+
+    def row(self, index: int) -> Row:
+        return Row(self, index)
+
+    def load(self, name: str, members):
+        try:
+            values = self.columns[name][members]
+        except KeyError:
+            raise NameError(f"name '{name}' is not defined") from None
+
+        if name in self.partial and any(value is UNSET for value in values):
+            raise NameError(f"name '{name}' is not defined")
+        return values
+
+    def _writable(self, name: str, kind: Optional[str], members):
+        # Column for name able to hold values of the given dtype kind, with
+        # None meaning arbitrary Python objects
+        column = self.columns.get(name)
+        if np.size(members) == self.size:
+            # Every session is overwritten: start a fresh column of that kind
+            column = self.columns[name] = np.empty(self.size, dtype=DTYPES[kind])
+            self.partial.discard(name)
+        elif column is None:
+            column = self.columns[name] = np.full(self.size, UNSET, dtype=object)
+            self.partial.add(name)
+        elif column.dtype != object and column.dtype.kind != kind:
+            column = self.columns[name] = column.astype(object)
+        return column
+
+    def store(self, name: str, members, values):
+        # Vectorized write of an array aligned with members, or a scalar
+        if np.ndim(values) == 0:
+            self.assign(name, members, _py(values))
+            return
+
+        column = self._writable(name, values.dtype.kind if values.dtype.kind in 'bif' else None, members)
+        column[members] = values if column.dtype != object else values.astype(object)
+
+    def assign(self, name: str, members, value):
+        kind = KINDS.get(type(value))
+        if kind == 'i' and not -1 << 63 <= value < 1 << 63:
+            kind = None
+        self._writable(name, kind, members)[members] = value
+
+    # ========================= Evaluation
+
+    def _vector(self, src: str, truth: bool) -> Optional[Vector]:
+        try:
+            return self._vectors[src, truth]
+        except KeyError:
+            fn = self._vectors[src, truth] = vectorize(src, truth)
+            return fn
+
+    def evaluate(self, src: str, members, truth: bool = False):
+        fn = self._vector(src, truth)
+        if fn is not None:
+            return fn(self, members)
+
+        ev = evaluator(src)
+        values = np.empty(len(members), dtype=object)
+        values[:] = [ev(Row(self, k)) for k in members.tolist()]
+        return values
+
+    def condition(self, src: str, members):
+        return _truth(self.evaluate(src, members, truth=True), len(members))
+
+    # ========================= Scheduling
+
+    def tick(self) -> list[Group]:
+        # Advances every runnable group until it suspends or halts; groups
+        # reaching the same instruction with nothing pushed are merged.
+        # Returns the suspended groups.
+        heap = []
+        parked = []
+        seq = 0
+        for group in self.groups:
+            if group.state is READY:
+                heapq.heappush(heap, (group.ip, seq, group))
+                seq += 1
+            else:
+                parked.append(group)
+
+        while heap:
+            _, _, group = heapq.heappop(heap)
+            while heap and heap[0][0] == group.ip and not group.stack and not heap[0][2].stack:
+                other = heapq.heappop(heap)[2]
+                group.members = np.concatenate((group.members, other.members))
+
+            if group.ip >= len(self.chunk):
+                group.state = HALTED
+                parked.append(group)
+                continue
+
+            itype, args = self.chunk[group.ip]
+            self.steps += len(group)
+            for out in self.cmds[itype](group, *args):
+                if not len(out):
+                    continue
+                if out.state is READY:
+                    heapq.heappush(heap, (out.ip, seq, out))
+                    seq += 1
+                else:
+                    parked.append(out)
+
+        self.groups = self._merge(parked)
+        return [group for group in self.groups if group.state is SUSPENDED]
+
+    def _merge(self, groups: list[Group]) -> list[Group]:
+        halted = [group for group in groups if group.state is HALTED]
+        groups = [group for group in groups if group.state is not HALTED]
+        if halted:
+            end = Group(len(self.chunk), np.concatenate([group.members for group in halted]))
+            end.state = HALTED
+            groups.append(end)
+        return groups
+
+    def resume(self, group: Group, choices=None):
+        # Continues a suspended group; at OPTIONS, choices gives each
+        # member's option index (or one index for all). Members whose choice
+        # is invalid stay parked at the menu.
+        if group.state is not SUSPENDED:
+            return
+
+        if not group.options:
+            group.state = READY
+            return
+
+        choices = np.broadcast_to(np.asarray(choices if choices is not None else -1), group.members.shape)
+        chosen = np.zeros(len(group), dtype=bool)
+        for idx, (_, valid, target) in enumerate(group.options):
+            mask = (choices == idx) & valid
+            if mask.any():
+                self.groups.append(Group(target, group.members[mask]))
+                chosen |= mask
+
+        if chosen.any():
+            self.groups.remove(group)
+            if not chosen.all():
+                rest = Group(group.ip, group.members[~chosen], options=[
+                    (texts[~chosen] if np.ndim(texts) else texts, valid[~chosen], target)
+                    for texts, valid, target in group.options])
+                rest.state = SUSPENDED
+                rest.render = self._options_render(rest)
+                self.groups.append(rest)
+
+    @property
+    def halted(self) -> bool:
+        return all(group.state is HALTED for group in self.groups)
+
+    def run(self, on_suspend: Callable[[Group], Any] = None, max_ticks: int = None) -> int:
+        # Plays every session to the end, letting on_suspend return the
+        # choice for groups waiting at OPTIONS; returns the ticks taken
+        ticks = 0
+        while not self.halted and (max_ticks is None or ticks < max_ticks):
+            for group in self.tick():
+                self.resume(group, on_suspend(group) if on_suspend else 0)
+            ticks += 1
+        return ticks
+
+    # ========================= Instructions
+    # Each takes a group at its ip and returns the groups it becomes
+
+    def expr(self, g: Group, expr: str):
+        truth = g.ip + 1 < len(self.chunk) and self.chunk[g.ip + 1][0] == IType.OP_JUMP_FALSE
+        g.stack.append(self.evaluate(expr, g.members, truth))
+        g.ip += 1
+        return (g,)
+
+    def _branch(self, g: Group, mask, offset: int):
+        if mask.all():
+            g.ip += 1
+            return (g,)
+        if not mask.any():
+            g.ip += offset
+            return (g,)
+
+        true, false = g.split(mask)
+        true.ip += 1
+        false.ip += offset
+        return true, false
+
+    def jump_if_false(self, g: Group, offset: int = 1):
+        return self._branch(g, _truth(g.stack.pop(), len(g)), offset)
+
+    def expr_jump_if_false(self, g: Group, expr: str, offset: int):
+        return self._branch(g, self.condition(expr, g.members), offset)
+
+    def jump(self, g: Group, offset: int):
+        g.ip += offset
+        return (g,)
+
+    def goto(self, g: Group, label: str):
+        g.ip = self.labels[label]
+        return (g,)
+
+    def label(self, g: Group, *_):
+        g.ip += 1
+        return (g,)
+
+    def code(self, g: Group, code: str):
+        form = assign(code)
+        if form and form[0] == 'set' and isinstance(form[2], (bool, int, float, str, type(None))):
+            self.assign(form[1], g.members, form[2])
+        elif form and form[0] == 'aug' and form[1] not in self.partial:
+            fn = getattr(operator, form[2])
+            self.store(form[1], g.members, fn(self.load(form[1], g.members), form[3]))
+        elif form and form[0] == 'set_expr' and self._vector(form[2], False):
+            self.store(form[1], g.members, self.evaluate(form[2], g.members))
+        else:
+            for k in g.members.tolist():
+                exec(code, GLOBALS, Row(self, k))
+
+        g.ip += 1
+        return (g,)
+
+    def _suspend(self, g: Group, render: Callable[[], list[Event]]):
+        g.state = SUSPENDED
+        g.render = render
+        return (g,)
+
+    def line(self, g: Group):
+        text = g.stack.pop()
+        speaker = g.stack.pop()
+        g.ip += 1
+        return self._suspend(g, self._line_render(g, speaker, text))
+
+    def expr_line(self, g: Group, speaker: str, text: str):
+        g.ip += 1
+        return self._suspend(g, lambda: self._line_render(g, self.evaluate(speaker, g.members),
+                                                          self.evaluate(text, g.members))())
+
+    def _line_render(self, g: Group, speaker, text):
+        def render():
+            n = len(g)
+            speakers = speaker.tolist() if np.ndim(speaker) else [speaker] * n
+            texts = text.tolist() if np.ndim(text) else [text] * n
+            return [Event(E.LINE, pair) for pair in zip(speakers, texts)]
+
+        return render
+
+    def tags(self, g: Group, *tags: str):
+        event = Event(E.TAGS, tags)
+        g.ip += 1
+        return self._suspend(g, lambda: [event] * len(g))
+
+    def add_option(self, g: Group, text: str, condition: Union[str, bool], offset: int):
+        # A bool condition was folded by the optimizer
+        valid = np.full(len(g), condition) if isinstance(condition, bool) else self.condition(condition, g.members)
+        g.options.append((self.evaluate(text, g.members), valid, g.ip + offset))
+        g.ip += 1
+        return (g,)
+
+    def exec_options(self, g: Group):
+        return self._suspend(g, self._options_render(g))
+
+    def _options_render(self, g: Group):
+        def render():
+            n = len(g)
+            columns = [(texts.tolist() if np.ndim(texts) else [texts] * n, valid.tolist())
+                       for texts, valid, _ in g.options]
+            return [Event(E.OPTIONS, tuple((texts[j], valid[j]) for texts, valid in columns)) for j in range(n)]
+
+        return render
+
+
+# %%
+if __name__ == '__main__':
+    import timeit
+
+    CROWD = [
+        (IType.EXEC_CODE, ('mood = 0',)),
+        (IType.LABEL, ('Loop',)),
+        (IType.OP_EXPR_JUMP_FALSE, ('hp > 50 and not angry', 3)),
+        (IType.EXEC_CODE, ('mood += 1',)),
+        (IType.OP_JUMP, (2,)),
+        (IType.EXEC_CODE, ('mood -= 1',)),
+        (IType.EXEC_CODE, ('hp -= 7',)),
+        (IType.OP_EXPR_JUMP_FALSE, ('hp > 0', 2)),
+        (IType.EXEC_GOTO, ('Loop',))
+    ]
+
+    b = Batch(CROWD, 100000, {'hp': 100, 'angry': False})
+    b.columns['hp'][:] = np.random.default_rng(0).integers(1, 200, b.size)
+    elapsed = timeit.timeit(b.run, number=1)
+    print(f'{b.steps:,} session-steps in {elapsed:.3f}s: {b.steps / elapsed:,.0f}/s')
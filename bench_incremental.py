@@ -0,0 +1,42 @@
+# %%
+import timeit
+from compiler import Compiler
+from incremental import LiveScript
+from scanner import scan_buffer
+
+
+def build(sections=500) -> str:
+    with open('TestDS.zds', 'r', encoding='utf-8') as f:
+        section = f.read().rstrip('\n') + '\n\n'
+    return ''.join(f'label section{i}\n' + section for i in range(sections))
+
+
+def bench(number=5, repeat=3):
+    source = build()
+    live = LiveScript(source)
+
+    # Retype one line's text back and forth in the middle of the script
+    at = source.index("'something'", len(source) // 2)
+    edits = [(at, at + len("'something'"), "'something else'"), (at, at + len("'something else'"), "'something'")]
+
+    def edit():
+        for start, end, text in edits:
+            live.edit(start, end, text)
+
+    def full():
+        for start, end, text in edits:
+            Compiler().compile(scan_buffer(live.source[:start] + text + live.source[end:]))
+
+    assert live.instructions == Compiler().compile(scan_buffer(source))
+    best = {fn.__name__: min(timeit.repeat(fn, number=number, repeat=repeat)) / (number * len(edits))
+            for fn in (full, edit)}
+
+    print(f'{len(source) / 1024:,.0f} KB, {len(live.buffers):,} statements')
+    for name, each in best.items():
+        print(f'{name:>10}: {each * 1000:,.2f} ms/edit')
+    print(f'   speedup: {best["full"] / best["edit"]:,.0f}x')
+
+
+# %%
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,66 @@
+# %%
+import timeit
+import tracemalloc
+from io import StringIO
+from lexer import _postproc_tokens, _read_tokens
+from scanner import scan, scan_buffer
+
+
+def build(size=4 * 1024 * 1024) -> str:
+    # Repeat the sample scripts, under fresh labels, to a multi-megabyte source
+    with open('TestDS.zds', 'r', encoding='utf-8') as f:
+        section = f.read().rstrip('\n') + '\n\n'
+
+    parts, total, i = [], 0, 0
+    while total < size:
+        part = f'label section{i}\n' + section
+        parts.append(part)
+        total += len(part)
+        i += 1
+    return ''.join(parts)
+
+
+def stdlib(source: str) -> list:
+    return list(_postproc_tokens(_read_tokens(StringIO(source).readline)))
+
+
+def scanner(source: str) -> list:
+    return list(scan(StringIO(source).readline))
+
+
+def buffer(source: str):
+    return scan_buffer(source)
+
+
+def peak(fn, source: str) -> int:
+    # Peak bytes allocated while scanning, with the result still held
+    tracemalloc.start()
+    tokens = fn(source)
+    _, top = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tokens
+    return top
+
+
+def bench(number=1, repeat=3):
+    source = build()
+    expected = stdlib(source)
+    assert expected == scanner(source), 'scanner and stdlib paths disagree'
+    assert expected == list(buffer(source)), 'buffer and stdlib paths disagree'
+
+    best = {fn.__name__: min(timeit.repeat(lambda: fn(source), number=number, repeat=repeat))
+            for fn in (stdlib, scanner, buffer)}
+
+    mb = len(source) / (1024 * 1024)
+    for name, total in best.items():
+        print(f'{name:>10}: {mb * number / total:,.2f} MB/s')
+    print(f'   speedup: {best["stdlib"] / best["scanner"]:.2f}x scanner, {best["stdlib"] / best["buffer"]:.2f}x buffer')
+
+    count = len(expected)
+    for fn in (scanner, buffer):
+        print(f'{fn.__name__:>10}: {peak(fn, source) / count:,.1f} bytes/token')
+
+
+# %%
+if __name__ == '__main__':
+    bench()
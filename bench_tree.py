@@ -0,0 +1,49 @@
+# %%
+import timeit
+import astnodes as N
+from interpreter import Interpreter
+from treecompile import CompiledInterpreter
+from sinks import NullSink
+
+
+def build(sections=200) -> N.BlockNode:
+    # Dialogue Designer-style tree: blocks of code, lines and option groups
+    root = N.BlockNode('', [N.CodeNode('n = 0')])
+    for i in range(sections):
+        stay, leave = N.OptionNode('Stay'), N.OptionNode('Leave', condition='n > 2')
+        stay.add_child(N.CodeNode('n += 1'))
+        stay.add_child(N.LineNode('"Bob"', 'f"Staying {n}"'))
+        menu = N.OptionGroup()
+        menu.add_child(stay)
+        menu.add_child(leave)
+        root.add_child(N.BlockNode(f'section{i}', [
+            N.LineNode('"Bob"', '"Hello"', tags=['calm']),
+            N.LineNode('"Bob"', 'f"n is {n}"', condition='n >= 0'),
+            menu,
+            N.LineNode('"Player"', '"Bye"', condition='n < 0')
+        ]))
+    return root
+
+
+def play(it: Interpreter):
+    it.run()
+    while it.frames or it.options:
+        it.next(0)
+
+
+def bench(number=20, repeat=5):
+    tree = build()
+    cases = (('walker', Interpreter(tree, NullSink())), ('compiled', CompiledInterpreter(tree, NullSink())))
+    best = {name: float('inf') for name, _ in cases}
+    for _ in range(repeat):
+        for name, it in cases:
+            best[name] = min(best[name], timeit.timeit(lambda: play(it), number=number))
+
+    for name, total in best.items():
+        print(f'{name:>10}: {number / total:,.1f} plays/s')
+    print(f'   speedup: {best["walker"] / best["compiled"]:.2f}x')
+
+
+# %%
+if __name__ == '__main__':
+    bench()
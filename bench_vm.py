@@ -0,0 +1,144 @@
+# %%
+import io
+import timeit
+from contextlib import redirect_stdout
+from vm import VM, C, resolve_labels
+from tokens import InstructionType as IType, EventType as E
+
+
+# Reference copy of the original getattr/_lastip run loop
+LEGACY_METHODS = {
+    IType.OP_JUMP_FALSE: 'jump_if_false',
+    IType.OP_EXPR: 'expr',
+    IType.EXEC_LINE: 'line',
+    IType.EXEC_CODE: 'code',
+    IType.EXEC_GOTO: 'goto',
+    IType.LABEL: 'label'
+}
+
+
+# Compile mode of the source argument, for instructions that take one
+LEGACY_SOURCE = {IType.OP_EXPR: 'eval', IType.EXEC_CODE: 'exec'}
+
+
+def load_legacy(chunk: list) -> list:
+    return [(itype, tuple(compile(arg, '<src>', LEGACY_SOURCE[itype]) for arg in args)
+             if itype in LEGACY_SOURCE else tuple(args)) for itype, args in chunk]
+
+
+class LegacyVM:
+
+    def __init__(self) -> None:
+        self.chunk: list = list()
+        self.labels: dict[str, int] = dict()
+        self._ip: int = 0
+        self._lastip: int = -1
+        self.valuestack: list = list()
+        self.inputstack: list = list()
+        self.locals = dict()
+
+    @property
+    def ip(self):
+        return self._ip
+
+    @ip.setter
+    def ip(self, value):
+        self._ip = value
+
+    def load(self, chunk: list):
+        self.labels = resolve_labels(chunk)
+        self.chunk = load_legacy(chunk)
+        self.reset()
+
+    def reset(self):
+        self.valuestack.clear()
+        self.inputstack.clear()
+        self.ip = 0
+        self._lastip = -1
+
+    def run(self):
+        while self._lastip != self.ip and self.ip < len(self.chunk):
+            self._lastip = self.ip
+            instr = self.chunk[self.ip]
+            if LEGACY_METHODS.get(instr[0], None):
+                fn = getattr(self, LEGACY_METHODS[instr[0]])
+                fn(*instr[1])
+
+    def code(self, code):
+        exec(code, None, self.locals)
+        self.ip += 1
+
+    def goto(self, label: str):
+        self.ip = self.labels[label]
+
+    def label(self, _):
+        self.ip += 1
+
+    def line(self):
+        if self.inputstack:
+            self.inputstack.pop()
+        text = self.valuestack.pop()
+        speaker = self.valuestack.pop()
+        print(f'{speaker}: {text}')
+
+    def expr(self, expr):
+        self.valuestack.append(eval(expr, None, self.locals))
+        self.ip += 1
+
+    def jump_if_false(self, offset=1):
+        if self.valuestack.pop():
+            self.ip += 1
+        else:
+            self.ip += offset
+
+    def send_input(self, idx=-1):
+        self.inputstack.append(idx)
+        self.ip += 1
+        self.run()
+
+
+# Instructions executed by one full pass over C
+STEPS = 8
+
+
+def play_legacy(vm: LegacyVM):
+    vm.reset()
+    vm.run()
+    while vm.ip < len(vm.chunk):
+        vm.send_input()
+
+
+LINE, END = E.LINE, E.END
+
+
+def play(vm: VM):
+    vm.reset()
+    kind, args = vm.run()
+    while kind is not END:
+        # Match the legacy loop, which prints every line
+        if kind is LINE:
+            print(f'{args[0]}: {args[1]}')
+        kind, args = vm.run()
+
+
+def bench(number=50000, repeat=7):
+    cases = (('legacy', play_legacy, LegacyVM()), ('prebound', play, VM()))
+    best = {name: float('inf') for name, *_ in cases}
+    with redirect_stdout(io.StringIO()):
+        for _, _, vm in cases:
+            vm.load(C)
+        # Interleave the cases so machine noise hits both equally
+        for _ in range(repeat):
+            for name, fn, vm in cases:
+                best[name] = min(best[name], timeit.timeit(lambda: fn(vm), number=number))
+
+    results = {name: STEPS * number / total for name, total in best.items()}
+
+    for name, ips in results.items():
+        print(f'{name:>10}: {ips:,.0f} instr/s')
+    print(f'   speedup: {results["prebound"] / results["legacy"]:.2f}x')
+
+
+# %%
+if __name__ == '__main__':
+    bench()
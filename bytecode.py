@@ -0,0 +1,286 @@
+# %%
+import mmap
+import struct
+import sys
+from array import array
+from collections.abc import Mapping, Sequence
+from enum import Enum
+from typing import Any, Iterable
+from tokens import InstructionType as IType
+
+
+class ChunkError(ValueError):
+    pass
+
+
+def resolve_labels(chunk: Iterable[tuple[IType, tuple]]) -> dict[str, int]:
+    labels: dict[str, int] = {}
+    for i, (itype, args) in enumerate(chunk):
+        if itype == IType.LABEL:
+            if args[0] in labels:
+                raise ChunkError(f"Duplicate label '{args[0]}' at {i}")
+            labels[args[0]] = i + 1
+
+    for i, (itype, args) in enumerate(chunk):
+        if itype == IType.EXEC_GOTO and args[0] not in labels:
+            raise ChunkError(f"Unresolved label '{args[0]}' at {i}")
+
+    return labels
+
+
+class Program(Sequence):
+    # Packed, read-only instruction stream:
+    #   opcodes[i]                          -> enum value of instruction i
+    #   operands[argstart[i]:argstart[i+1]] -> indices into constants
+    # Constants are deduplicated, so repeated labels, speakers and
+    # expressions are stored once per program.
+    __slots__ = ('optype', 'opcodes', 'argstart', 'operands', 'constants')
+
+    def __init__(self, optype: type[Enum], opcodes: array, argstart: array, operands: array, constants: tuple) -> None:
+        self.optype = optype
+        self.opcodes = opcodes
+        self.argstart = argstart
+        self.operands = operands
+        self.constants = constants
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+
+        consts = self.constants
+        args = tuple(consts[k] for k in self.operands[self.argstart[idx]:self.argstart[idx + 1]])
+        return self.optype(self.opcodes[idx]), args
+
+    def __iter__(self):
+        consts, operands, argstart, optype = self.constants, self.operands, self.argstart, self.optype
+        for i, code in enumerate(self.opcodes):
+            yield optype(code), tuple(consts[k] for k in operands[argstart[i]:argstart[i + 1]])
+
+    def __getstate__(self):
+        return self.optype, self.opcodes, self.argstart, self.operands, self.constants
+
+    def __setstate__(self, state):
+        self.optype, self.opcodes, self.argstart, self.operands, self.constants = state
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.optype.__name__}, instructions={len(self)}, constants={len(self.constants)})'
+
+
+def _narrow(values: array) -> array:
+    # Re-store in the smallest unsigned typecode that holds every value
+    top = max(values, default=0)
+    for typecode in 'BHI':
+        if top < 1 << (8 * array(typecode).itemsize):
+            return array(typecode, values) if typecode != values.typecode else values
+
+    return values
+
+
+def pack(chunk: Iterable[tuple[Enum, Iterable[Any]]], optype: type[Enum] = IType) -> Program:
+    opcodes = array('B')
+    argstart = array('I', [0])
+    operands = array('I')
+    pool: dict[tuple[type, Any], int] = {}
+
+    for itype, args in chunk:
+        opcodes.append(itype.value)
+        for arg in args:
+            # Keyed on type too, so 1, 1.0 and True stay distinct
+            operands.append(pool.setdefault((type(arg), arg), len(pool)))
+        argstart.append(len(operands))
+
+    return Program(optype, opcodes, _narrow(argstart), _narrow(operands), tuple(value for _, value in pool))
+
+
+# %%
+# Binary container (.zdsb), little-endian, every section 8-byte aligned:
+#
+#   header    HEADER struct: magic, format version, reserved, counts for
+#             instructions / operands / constants / labels, then the byte
+#             offset of each section below
+#   opcodes   u8  x instructions
+#   argstart  u32 x (instructions + 1), offsets into operands
+#   operands  u32 x operands, indices into the constant table
+#   consts    u32 x 3 x constants: (kind, data offset, data length)
+#   labels    u32 x 2 x labels: (constant index of name, address), sorted
+#             by the UTF-8 bytes of the name
+#   data      string table: constant payloads, referenced by offset
+#
+# Constant payloads are UTF-8 text (str), decimal text (int), repr (float),
+# b'1'/b'0' (bool) or empty (None).
+
+BIN_MAGIC = b'ZDSB'
+BIN_VERSION = 1
+HEADER = struct.Struct('<4sHHIIII6Q')
+
+KIND_STR, KIND_INT, KIND_FLOAT, KIND_BOOL, KIND_NONE = range(5)
+
+_ENCODE = {
+    str: (KIND_STR, lambda v: v.encode('utf-8')),
+    int: (KIND_INT, lambda v: str(v).encode('ascii')),
+    float: (KIND_FLOAT, lambda v: repr(v).encode('ascii')),
+    bool: (KIND_BOOL, lambda v: b'1' if v else b'0'),
+    type(None): (KIND_NONE, lambda v: b'')
+}
+
+_DECODE = {
+    KIND_STR: lambda b: str(b, 'utf-8'),
+    KIND_INT: int,
+    KIND_FLOAT: float,
+    KIND_BOOL: lambda b: b == b'1',
+    KIND_NONE: lambda b: None
+}
+
+
+def _pad(buf: bytearray):
+    buf.extend(bytes(-len(buf) % 8))
+
+
+def dump(program: Program, path) -> None:
+    if not isinstance(program, Program):
+        program = pack(program)
+
+    labels = resolve_labels(program)
+    index = {(type(c), c): k for k, c in enumerate(program.constants)}
+    table = sorted((name.encode('utf-8'), index[(str, name)], addr) for name, addr in labels.items())
+
+    consts = array('I')
+    data = bytearray()
+    for const in program.constants:
+        if type(const) not in _ENCODE:
+            raise ChunkError(f'Cannot store constant of type {type(const).__name__}: {const!r}')
+        kind, encode = _ENCODE[type(const)]
+        payload = encode(const)
+        consts.extend((kind, len(data), len(payload)))
+        data.extend(payload)
+
+    sections = [
+        array('B', program.opcodes),
+        array('I', program.argstart),
+        array('I', program.operands),
+        consts,
+        array('I', (v for _, k, addr in table for v in (k, addr))),
+        data
+    ]
+
+    body = bytearray()
+    offsets = []
+    for section in sections:
+        offsets.append(HEADER.size + len(body))
+        body.extend(section.tobytes() if isinstance(section, array) else section)
+        _pad(body)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(BIN_MAGIC, BIN_VERSION, 0, len(program), len(program.operands),
+                            len(program.constants), len(table), *offsets))
+        f.write(body)
+
+
+class _LabelTable(Mapping):
+    # Binary search over the sorted on-disk table; nothing is read up front
+
+    def __init__(self, program: 'MappedProgram', table: memoryview) -> None:
+        self._program = program
+        self._table = table
+
+    def _name(self, i: int) -> bytes:
+        return self._program._payload(self._table[2 * i])
+
+    def __getitem__(self, name: str) -> int:
+        key = name.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < len(self) and self._name(lo) == key:
+            return self._table[2 * lo + 1]
+
+        raise KeyError(name)
+
+    def __iter__(self):
+        return (str(self._name(i), 'utf-8') for i in range(len(self)))
+
+    def __len__(self) -> int:
+        return len(self._table) // 2
+
+
+class MappedProgram(Sequence):
+    # Read-only Program view over an mmap'd .zdsb file. Instructions and
+    # constants are decoded from the mapped pages only when accessed, so
+    # opening costs the same for any file size and processes mapping the
+    # same file share its pages.
+
+    def __init__(self, path, optype: type[Enum] = IType) -> None:
+        if sys.byteorder != 'little':
+            raise ChunkError('Mapped programs require a little-endian host')
+
+        self.optype = optype
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buf = memoryview(self._mmap)
+        magic, version, _, n_instr, n_operands, n_consts, n_labels, *offsets = HEADER.unpack_from(buf)
+        if (magic, version) != (BIN_MAGIC, BIN_VERSION):
+            buf.release()
+            self._mmap.close()
+            raise ChunkError(f'{path} is not a version {BIN_VERSION} program file')
+
+        o_ops, o_argstart, o_operands, o_consts, o_labels, o_data = offsets
+        self.opcodes = buf[o_ops:o_ops + n_instr]
+        self.argstart = buf[o_argstart:o_argstart + 4 * (n_instr + 1)].cast('I')
+        self.operands = buf[o_operands:o_operands + 4 * n_operands].cast('I')
+        self._consts = buf[o_consts:o_consts + 12 * n_consts].cast('I')
+        self._data = buf[o_data:]
+        self.labels = _LabelTable(self, buf[o_labels:o_labels + 8 * n_labels].cast('I'))
+        self._views = [buf, self.opcodes, self.argstart, self.operands, self._consts, self._data, self.labels._table]
+
+    def _payload(self, k: int) -> bytes:
+        _, offset, length = self._consts[3 * k:3 * k + 3]
+        return self._data[offset:offset + length].tobytes()
+
+    def constant(self, k: int) -> Any:
+        return _DECODE[self._consts[3 * k]](self._payload(k))
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+
+        args = tuple(self.constant(k) for k in self.operands[self.argstart[idx]:self.argstart[idx + 1]])
+        return self.optype(self.opcodes[idx]), args
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.optype.__name__}, instructions={len(self)})'
+
+
+# %%
+if __name__ == '__main__':
+    from vm import C
+    P = pack(C)
+    print(P, P[3], list(P) == [(itype, tuple(args)) for itype, args in C])
@@ -0,0 +1,98 @@
+# %%
+import os
+import pickle
+from hashlib import sha256
+from pathlib import Path
+from typing import Iterable, Union
+import bytecode
+import compiler
+import exprs
+import scanner
+import symbols
+import tokens
+from bytecode import Program, pack
+from compiler import Compiler
+from scanner import scan_buffer
+
+# Cached programs live in a __zdscache__ folder next to each script, like
+# __pycache__, unless a separate cache directory is given.
+CACHE_DIR = '__zdscache__'
+CACHE_SUFFIX = '.zdsc'
+MAGIC = b'ZDSC'
+
+PathLike = Union[str, os.PathLike]
+
+# Modules whose code decides what an entry holds. Entries are keyed on their
+# source, so any change to how scripts compile invalidates the cache without
+# a version number to remember to bump.
+BUILD_MODULES = (compiler, scanner, symbols, exprs, tokens, bytecode)
+
+
+def source_key(source: bytes) -> str:
+    return sha256(source).hexdigest()
+
+
+def build_key(modules=BUILD_MODULES) -> str:
+    digest = sha256()
+    for module in modules:
+        digest.update(Path(module.__file__).read_bytes())
+    return digest.hexdigest()
+
+
+BUILD = build_key()
+
+
+def cache_path(path: PathLike, cache_dir: PathLike = None) -> Path:
+    path = Path(path).resolve()
+    if cache_dir is None:
+        return path.parent / CACHE_DIR / (path.name + CACHE_SUFFIX)
+
+    # Flat cache directory: disambiguate same-named scripts by their location
+    where = sha256(str(path.parent).encode()).hexdigest()[:16]
+    return Path(cache_dir) / f'{path.name}.{where}{CACHE_SUFFIX}'
+
+
+def compile_source(source: str) -> Program:
+    return pack(Compiler().compile(scan_buffer(source)))
+
+
+def _read(cpath: Path, key: str):
+    try:
+        with open(cpath, 'rb') as f:
+            magic, build, entry_key, program = pickle.load(f)
+    except (OSError, EOFError, ValueError, TypeError, AttributeError, ImportError, pickle.UnpicklingError):
+        return None
+
+    if (magic, build, entry_key) != (MAGIC, BUILD, key):
+        return None
+
+    return program
+
+
+def _write(cpath: Path, key: str, program: Program):
+    try:
+        cpath.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cpath.with_name(f'{cpath.name}.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump((MAGIC, BUILD, key, program), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cpath)
+    except OSError:
+        # A read-only tree just means no cache, same as __pycache__
+        pass
+
+
+def load_script(path: PathLike, cache_dir: PathLike = None) -> Program:
+    source = Path(path).read_bytes()
+    key = source_key(source)
+    cpath = cache_path(path, cache_dir)
+
+    program = _read(cpath, key)
+    if program is None:
+        program = compile_source(source.decode('utf-8'))
+        _write(cpath, key, program)
+
+    return program
+
+
+def load_scripts(paths: Iterable[PathLike], cache_dir: PathLike = None) -> dict[str, Program]:
+    return {str(path): load_script(path, cache_dir) for path in paths}
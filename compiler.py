@@ -1,7 +1,11 @@
 # %%
-from token import COLON
+from ast import literal_eval
+from io import TextIOBase
+from typing import Callable, Optional, Union
 from tokens import InstructionType as IType, Instruction as I, TokenType as T, Token
-from lexer import tokenize
+from scanner import Cursor, StreamCursor, TokenBuffer, TokenStream, cursor, scan_buffer
+from symbols import SymbolTable, resolve
+from exprs import validate
 
 
 # Order of ops:
@@ -15,236 +19,304 @@ class ScriptSyntaxError(SyntaxError):
     pass
 
 
-STMT_ARGS = {
-    T.LABEL: 1,
-    T.LINE: 2,
-    T.CHOICE: 1,
-    T.GOTO: 1
+STMT_DEF = {
+    'line': '_line',
+    'goto': '_goto',
+    'label': '_label',
+    'script': '_code'
 }
 
+VALUE_TYPES = (T.CONSTANT, T.NAME, T.EXPR)
 
-STMT_INSTR = {
-    T.LINE: IType.EXEC_LINE,
-    T.GOTO: IType.EXEC_GOTO,
-    T.LABEL: IType.LABEL,
-    T.CHOICE: IType.EXEC_LINE
-}
 
-STMT_DEF = {
-    T.LINE: ('_line', 2),
-    T.GOTO: ('_goto', 1),
-    T.LABEL: ('_label', 1),
-    T.CHOICE: ('_option', 1)
-}
+class Compiler:
 
+    def __init__(self, slots: bool = False) -> None:
+        # Tokens are read through a cursor: over a TokenBuffer, or pulled one
+        # at a time from a TokenStream while the source is still being read.
+        # Either gives `$` code its exact source text.
+        self.cursor: Union[Cursor, StreamCursor] = scan_buffer('').cursor()
+        self.instructions: list[I] = []
 
-PREC = {
-    T.LINE: 0,
-    T.IF: 1,
-    T.COLON: 2
-}
+        # Resolve script variables to slot indices after assembly
+        self.slots = slots
+        self.symbols: SymbolTable = SymbolTable((), frozenset())
 
+        # Assembler state: address of each symbolic label, and the indices of
+        # instructions whose last arg is a label still to be resolved
+        self._targets: list[int] = []
+        self._fixups: list[int] = []
 
-class Compiler:
+        # Speaker of the enclosing `line <speaker>:` block, if any
+        self._head: Optional[str] = None
+        self._heads: list[Optional[str]] = []
 
-    def __init__(self) -> None:
-        self.tokens: list[Token] = []
-        self.position: int = 0
-        self.instructions: list = []
+    @property
+    def currtoken(self) -> Optional[Token]:
+        return self.cursor.token()
 
     @property
-    def currtoken(self):
-        return self.tokens[self.position] if self.position < len(self.tokens) else None
+    def position(self) -> int:
+        # Number of tokens consumed
+        return self.cursor.index
+
+    def compile(self, code: Union[TokenBuffer, TokenStream, str, TextIOBase]):
+        self.cursor = cursor(code)
+        self.instructions = []
+        self._targets = []
+        self._fixups = []
+        self._head = None
+        self._heads = []
 
-    def compile(self, tokens: list[Token]):
-        self.tokens = tokens
-        self.position = 0
-        self.instructions.clear()
         self._script()
+        self._link()
+        if self.slots:
+            self.instructions, self.symbols = resolve(self.instructions)
+        return self.instructions
+
+    def check(self, tokentype: T, value: str = None) -> bool:
+        cur = self.cursor
+        return cur.type is tokentype and (value is None or cur.value == value)
+
+    def accept(self, tokentype: T, value: str = None) -> Optional[Token]:
+        if self.check(tokentype, value):
+            tk = self.currtoken
+            self.cursor.advance()
+            return tk
+
+        return None
+
+    def expect(self, tokentype: T, value: str = None, msg: str = '') -> Token:
+        return self.accept(tokentype, value) or self.error(msg)
 
     def consume(self, tokentype: T, *others: T):
         # print(f'Token: {self.currtoken}')
-        if self.currtoken.type in [tokentype, *others]:
+        if self.cursor.type in [tokentype, *others]:
             tk = self.currtoken
-            self.position += 1
+            self.cursor.advance()
             return tk
 
         self.error()
 
-    def write(self, instruction_type: IType, *args):
-        self.instructions.append((instruction_type, args))
-
-    def instruction(self, instruction_type: IType, *args):
-        return I(instruction_type, args)
-
     def error(self, msg: str = ''):
         row, col = self.currtoken.position
         raise ScriptSyntaxError(
             f"Line {row} ({col}), at '{self.currtoken.value}': {msg or 'Invalid syntax'} [{self.position}: {self.currtoken}]")
 
-    # =========================
+    # ========================= Assembler
+
+    def write(self, instruction_type: IType, *args):
+        self.instructions.append(I(instruction_type, args))
+
+    def write_jump(self, instruction_type: IType, label: int, *args):
+        # Offset is appended as the last arg once the label is resolved
+        self._fixups.append(len(self.instructions))
+        self.instructions.append(I(instruction_type, (*args, label)))
+
+    def label(self) -> int:
+        self._targets.append(-1)
+        return len(self._targets) - 1
+
+    def mark(self, label: int):
+        self._targets[label] = len(self.instructions)
+
+    def _link(self):
+        for idx in self._fixups:
+            itype, args = self.instructions[idx]
+            offset = self._targets[args[-1]] - idx
+            self.instructions[idx] = I(itype, (*args[:-1], offset))
+
+        self._fixups.clear()
+
+    # ========================= Grammar
 
     def _script(self):
-        while self.currtoken.type != T.END:
-            if self.currtoken.type == T.NEWLINE:
-                self.consume(T.NEWLINE)
+        while self.cursor.type is not T.END:
+            if self.accept(T.NEWLINE):
                 continue
 
-            self.instructions.extend(self._statement())
+            self._statement()
 
     def _statement(self):
-
-        if self.currtoken.type == T.CHOICE:
+        if self.check(T.STATEMENT, 'choice'):
             return self._option()
 
-        chunk = self._simple_stmt()
-
-        for fn in self._tags, self._ifclause:
-            if self.currtoken.type == T.NEWLINE:
-                self.consume(T.NEWLINE)
-                return chunk
+        if self._heads and self._heads[-1] is not None and self.cursor.type in VALUE_TYPES:
+            return self._clause(self._head_line)
 
-            chunk = fn(chunk)
+        self._clause(self._simple_stmt)
 
-        return chunk
+    def _clause(self, stmt: Callable[[], list[I]], suite: bool = True):
+        # single_stmt tags? if_clause? suite
+        head = stmt()
+        tags = self._tags()
 
-    def _compound_stmt(self):
-        pass
+        if head and head[0].type is IType.LABEL:
+            # A goto lands on the label, so whatever follows it still runs
+            self.instructions.extend(head)
+            self.instructions.extend(tags)
+            head, tags = [], []
 
-    def _chunk(self):
-        return [I(IType.EXEC_LINE)]
+        end = None
+        if self.accept(T.OPERATOR, 'if'):
+            end = self.label()
+            self.write(IType.OP_EXPR, self._expr())
+            self.write_jump(IType.OP_JUMP_FALSE, end)
 
-    def _suite(self, left=None):
-        left = left or []
-        chunk = []
+        self.instructions.extend(tags)
+        self.instructions.extend(head)
 
-        if self.currtoken.type == T.COLON:
-            try:
-                self.consume(T.COLON)
-                self.consume(T.NEWLINE)
-                self.consume(T.INDENT)
-            except ScriptSyntaxError:
-                self.error('Expected an indented block.')
+        if suite:
+            self._suite()
 
-            while self.currtoken.type != T.DEDENT:
-                chunk.extend(self._statement())
+        if end is not None:
+            self.mark(end)
 
-            self.consume(T.DEDENT)
+    def _suite(self):
+        head, self._head = self._head, None
 
-        elif self.currtoken.type == T.CONCAT:
-            while self.currtoken.type == T.CONCAT:
-                self.consume(T.CONCAT)
-                chunk.extend(self._simple_stmt())
-                chunk.extend(self._tags())
-                chunk.extend(self._ifclause())
+        if self.accept(T.OPERATOR, ':'):
+            if not (self.accept(T.NEWLINE) and self.accept(T.INDENT)):
+                self.error('Expected an indented block.')
 
-            self.consume(T.NEWLINE)
+            self._heads.append(head)
+            while not self.accept(T.DEDENT):
+                if not self.accept(T.NEWLINE):
+                    self._statement()
+            self._heads.pop()
 
-        elif self.currtoken.type == T.NEWLINE:
-            self.consume(T.NEWLINE)
+        elif self.check(T.OPERATOR, '|'):
+            while self.accept(T.OPERATOR, '|'):
+                self._clause(self._simple_stmt, suite=False)
 
-        return chunk
+            self.expect(T.NEWLINE)
 
-    def _head(self):
-        
+        else:
+            self.expect(T.NEWLINE)
 
     def _simple_stmt(self):
-        if (stmt := self.currtoken.type) in STMT_ARGS:
-            method, *_ = STMT_DEF[stmt]
-            return getattr(self, method)()
+        if self.check(T.STATEMENT) and self.cursor.value in STMT_DEF:
+            return getattr(self, STMT_DEF[self.cursor.value])()
 
         self.error('Unrecognized statement.')
 
+    def _check(self, src: str, position: tuple[int, int], mode: str = 'eval') -> str:
+        # Embedded Python is syntax-checked here, once, rather than at run time
+        try:
+            validate(src, mode, position)
+        except SyntaxError as e:
+            raise ScriptSyntaxError(f'Line {e.lineno} ({e.offset}): {e.msg}') from None
+        return src
+
+    def _value(self) -> str:
+        tk = self.consume(*VALUE_TYPES)
+        return self._check(tk.value, tk.position) if tk.type == T.EXPR else tk.value
+
+    def _expr(self) -> str:
+        tk = self.expect(T.EXPR, msg='Expected an expression.')
+        return self._check(tk.value, tk.position)
+
     def _line(self):
-        self.consume(T.LINE)
-        spkr = self.consume(T.STRING, T.NAME, T.EXPR).value
-        text = self.consume(T.STRING, T.NAME, T.EXPR).value
+        self.expect(T.STATEMENT, 'line')
+        spkr = self._value()
 
-        return [I(IType.EXEC_LINE, (spkr, text))]
+        if self.cursor.type not in VALUE_TYPES:
+            # `line <speaker>:` opens a block of lines by that speaker
+            self._head = spkr
+            return []
 
-    def _label(self):
-        self.consume(T.LABEL)
-        name = self.currtoken.value
-        self.consume(T.NAME)
-        self.instructions.append(I(IType.LABEL, (name,)))
-        return []
+        return self._emit_line(spkr, self._value())
 
-    def _option(self):
-        arglists = []
-        suites = []
-        while self.currtoken.type == T.CHOICE:
-            self.consume(T.CHOICE)
-            args = []
-            args.append(self.consume(T.STRING, T.NAME, T.EXPR).value)
-
-            tags = self._tags()
-
-            if self.currtoken.type == T.IF:
-                self.consume(T.IF)
-                args.append(self.consume(T.EXPR).value)
-            else:
-                args.append('True')
+    def _head_line(self):
+        return self._emit_line(self._heads[-1], self._value())
 
-            arglists.append(args)
+    def _emit_line(self, spkr: str, text: str):
+        return [I(IType.OP_EXPR, (spkr,)), I(IType.OP_EXPR, (text,)), I(IType.EXEC_LINE)]
 
-            suites.append(tags + self._suite() + ['TEMP_JUMP'])
+    def _label(self):
+        self.expect(T.STATEMENT, 'label')
+        return [I(IType.LABEL, (self.consume(T.NAME).value,))]
+
+    def _goto(self):
+        self.expect(T.STATEMENT, 'goto')
+        return [I(IType.EXEC_GOTO, (self.consume(T.NAME).value,))]
+
+    def _code(self):
+        # The code is the source text up to the end of the line or a `|`
+        # outside brackets, sliced as written
+        self.expect(T.STATEMENT, 'script')
+        cur = self.cursor
+        start, end, position = cur.start, cur.start, cur.position
+        depth = 0
+        while not self.check(T.NEWLINE) and not (depth == 0 and self.check(T.OPERATOR, '|')):
+            if cur.type is T.OPERATOR:
+                value = cur.value
+                depth += (value in ('(', '[')) - (value in (')', ']'))
+            end = cur.end
+            self.consume(T.CONSTANT, T.NAME, T.OPERATOR, T.EXPR, T.STATEMENT)
+
+        return [I(IType.EXEC_CODE, (self._check(cur.source(start, end), position, 'exec'),))]
 
-        out = []
-        for i, arglist in enumerate(arglists):
-            arglist.append(1 +
-                           sum(len(suite) for suite in suites[:i]))
-            out.append(I(IType.ADD_OPTION, tuple(arglist)))
+    def _option(self):
+        # Suites are emitted as they are parsed; the ADD_OPTION table that
+        # points into them follows, reached by a jump over the suites
+        options: list[tuple[str, str, int]] = []
+        menu, end = self.label(), self.label()
+        self.write_jump(IType.OP_JUMP, menu)
+
+        while self.accept(T.STATEMENT, 'choice'):
+            if self.accept(T.OPERATOR, ':'):
+                if not (self.accept(T.NEWLINE) and self.accept(T.INDENT)):
+                    self.error('Expected an indented block.')
+
+                while not self.accept(T.DEDENT):
+                    if not self.accept(T.NEWLINE):
+                        options.append(self._choice(end))
+            else:
+                options.append(self._choice(end))
 
-        out.append(I(IType.EXEC_OPTIONS))
-        total = sum(len(suite) for suite in suites) + len(out)
-        for suite in suites:
-            suite[-1] = I(IType.OP_JUMP, (
-                total - len(out) - len(suite) + 1, )
-            )
-            out.extend(suite)
+            while self.accept(T.NEWLINE):
+                pass
 
-        return out
+        self.mark(menu)
+        for text, condition, target in options:
+            self.write_jump(IType.ADD_OPTION, target, text, condition)
+        self.write(IType.EXEC_OPTIONS)
+        self.mark(end)
 
-    def _ifclause(self, left=None):
-        left = left or []
-        out = left
-        if self.currtoken.type == T.IF:
-            self.consume(T.IF)
-            if not self.currtoken.type == T.EXPR:
-                self.error('Expected an expression.')
+    def _choice(self, end: int):
+        text = self._value()
+        tags = self._tags()
+        condition = self._expr() if self.accept(T.OPERATOR, 'if') else 'True'
 
-            expr = self.consume(T.EXPR).value
-            suite = self._suite()
+        start = len(self.instructions)
+        self.instructions.extend(tags)
+        self._suite()
 
-            out = [I(IType.OP_JUMP_FALSE, (expr, len(
-                left) + len(suite) + 1))] + left + suite
+        if len(self.instructions) == start:
+            return text, condition, end
 
-        return out
+        target = self.label()
+        self._targets[target] = start
+        self.write_jump(IType.OP_JUMP, end)
+        return text, condition, target
 
-    def _tags(self, left=None):
-        left = left or []
-        out = []
-        if self.currtoken.type == T.LBRACKET:
-            self.consume(T.LBRACKET)
-            tags = []
-            while self.currtoken.type != T.RBRACKET:
-                tags.append(self.consume(T.STRING).value)
+    def _tags(self):
+        if not self.accept(T.OPERATOR, '['):
+            return []
 
-            self.consume(T.RBRACKET)
-            out.append(I(IType.EXEC_TAGS, tuple(tags)))
+        tags = []
+        while not self.accept(T.OPERATOR, ']'):
+            tags.append(literal_eval(self.consume(T.CONSTANT).value))
 
-        return left + out
+        return [I(IType.EXEC_TAGS, tuple(tags))]
 
 
 # %%
-c = Compiler()
-tkns = list(tokenize(open('TestDS.zds', 'r')))
-c.compile(tkns)
-# %%
-try:
-    c.compile(tkns)
-finally:
-    c.instructions
+if __name__ == '__main__':
+    with open('TestDS.zds', 'r', encoding='utf-8') as f:
+        c = Compiler()
+        c.compile(scan_buffer(f))
 
 # %%
 # line_stmt NEWLINE => exec_line
@@ -256,4 +328,4 @@ finally:
 # line_stmt tags COLON stmt1 stmt2 DEDENT => tags exec_line stmt1 stmt2
 # line_stmt ifclause COLON stmt1 stmt2 DEDENT => ifclause exec_line stmt1 stmt2
 
-# option tags if COLON block => option(ifexpr, jump) (jumptgt)-> tags block
+# option tags if COLON block => jump(menu) (tgt)-> tags block jump(end) ... (menu)-> option(text, ifexpr, tgt) ... exec_options
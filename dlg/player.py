@@ -1,7 +1,11 @@
 # %%
 from typing import NamedTuple
 from enum import Enum, auto
-from typing import Any, Sequence
+from typing import Any, Mapping, Sequence, Union
+from store import VarStore
+from exprs import ConditionCache, evaluator, template
+from sinks import ConsoleSink, EventSink
+from tokens import EventType as E, Event
 
 
 class InstructionType(Enum):
@@ -18,6 +22,8 @@ class InstructionType(Enum):
 
 I = InstructionType
 
+# Scripts see builtins only; their variables live in the player's context
+GLOBALS: dict[str, Any] = {}
 
 
 
@@ -30,47 +36,64 @@ class Instruction(NamedTuple):
     #     self.args = args
 
 
-class DlgPlayer:
+class Script(NamedTuple):  # pylint: disable=inherit-non-class
+    # Instructions and their section table, shared by every DlgPlayer
+    # playing them. Instructions may be Instruction tuples or a packed
+    # bytecode.Program.
+    instructions: Sequence[Instruction]
+    sections: Mapping[str, int]
+
+    def session(self, context: Mapping[str, Any] = None, sink: EventSink = None) -> 'DlgPlayer':
+        return DlgPlayer(self, context, sink)
+
 
-    def __init__(self, instructions: Sequence[Instruction], context: dict[str, Any] = None) -> None:
-        self.instructions = instructions
-        self.context = context or dict()
+def load(instructions: Sequence[Instruction]) -> Script:
+    return Script(instructions, {args[0]: i for i, (itype, args) in enumerate(instructions) if itype == I.SECTION})
+
+
+class DlgPlayer:
+    # Per-playthrough state only; the Script is shared by every player
+    __slots__ = ('program', 'sink', 'context', 'conditions', 'index', 'scope')
+
+    def __init__(self,
+                 program: Union[Script, Sequence[Instruction]],
+                 context: Mapping[str, Any] = None,
+                 sink: EventSink = None) -> None:
+        self.program = program if isinstance(program, Script) else load(program)
+        self.sink: EventSink = sink if sink is not None else ConsoleSink()
+        # Writes land in a per-player overlay; the passed-in context is shared
+        self.context = VarStore(context)
+        self.conditions = ConditionCache(self.context)
 
         self.index = 0
         self.scope: list[str] = []
-        self.sections: dict[str, int] = {instr.args[0]: i
-                                         for i, instr in enumerate(self.instructions)
-                                         if instr.instruction_type == I.SECTION}
-
-        self.cmds = {
-            I.SECTION: self.section,
-            I.LINE: self.line,
-            I.JUMP_IF_FALSE: self.jump_if_false,
-            I.SET_LOCAL: self.set_local,
-            I.GOTO: self.goto,
-            I.SCRIPT: self.script,
-            I.END: self.end
-        }
+
+    @property
+    def instructions(self) -> Sequence[Instruction]:
+        return self.program.instructions
 
     def play(self, start=0):
         self.index = start
+        instructions, cmds = self.program.instructions, CMDS
 
-        while self.index < len(self.instructions):
-            instr = self.instructions[self.index]
+        while self.index < len(instructions):
+            itype, args = instructions[self.index]
 
-            self.cmds[instr.instruction_type](instr.args)
+            cmds[itype](self, args)
 
-        print('END')
+        self.sink.emit(Event(E.END))
+        self.sink.flush()
 
     def jump_if_false(self, args: tuple[str, int]):
         condition, i = args
-        self.index += 1 if eval(condition, self.context) else i+1
+        self.index += 1 if self.conditions.value(condition) else i+1
 
     def line(self, args: tuple[str, str]):
-        speaker = eval(f'{args[0]}', self.context)
-        text = eval(f'f{args[1]}', self.context)
-        print(f'{speaker}: {text}')
-        if input('') == 'EXIT':
+        speaker = evaluator(args[0])(self.context)
+        text = template(args[1], quoted=True)(self.context)
+        event = Event(E.LINE, (speaker, text))
+        self.sink.emit(event)
+        if self.sink.respond(event) == 'EXIT':
             self.end()
         self.index += 1
 
@@ -79,18 +102,30 @@ class DlgPlayer:
         self.index += 1
 
     def set_local(self, args: tuple[str, str]):
-        self.context[args[0]] = eval(args[1], globals(), self.context)
+        self.conditions.assign(args[0], eval(args[1], GLOBALS, self.context))
         self.index += 1
 
     def goto(self, args: tuple[str]):
-        self.index = self.sections.get(args[0], len(self.instructions))
+        self.index = self.program.sections.get(args[0], len(self.program.instructions))
 
     def script(self, args: tuple[str]):
-        exec(args[0], globals(), self.context)
+        self.conditions.exec(args[0], GLOBALS)
         self.index += 1
 
     def end(self, _=None):
-        self.index = len(self.instructions)
+        self.index = len(self.program.instructions)
+
+
+# One handler per instruction type, shared by every player
+CMDS = {
+    I.SECTION: DlgPlayer.section,
+    I.LINE: DlgPlayer.line,
+    I.JUMP_IF_FALSE: DlgPlayer.jump_if_false,
+    I.SET_LOCAL: DlgPlayer.set_local,
+    I.GOTO: DlgPlayer.goto,
+    I.SCRIPT: DlgPlayer.script,
+    I.END: DlgPlayer.end
+}
 
 # %%
 
@@ -111,8 +146,9 @@ instr_list = [
     Instruction(I.GOTO, ('START', ))
 ]
 # %%
-p = DlgPlayer(instr_list, {'player': 'Bill', 'times': 0, 'met_player': False})
-p.play()
+if __name__ == '__main__':
+    p = DlgPlayer(instr_list, {'player': 'Bill', 'times': 0, 'met_player': False})
+    p.play()
 # %%
 
 def getstuff(a):
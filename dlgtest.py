@@ -1,15 +1,33 @@
 # %%
 from abc import ABC, abstractmethod
-from typing import Any, Mapping, Optional
+from typing import Any, Mapping, NamedTuple, Sequence, Union
+from collections import ChainMap
 from functools import singledispatchmethod
+from exprs import ConditionCache, evaluator
+from sinks import ConsoleSink, EventSink
+from tokens import EventType as E, Event
 
 
 class DlgNode(ABC):
     def __init__(self, condition: str = '') -> None:
         self.condition = condition
 
-    def is_valid(self, global_context: dict[str, Any] = None, local_context: Mapping[str, Any] = None) -> bool:
-        return bool(eval(self.condition, global_context, local_context)) if self.condition else True
+    def is_valid(self,
+                 global_context: dict[str, Any] = None,
+                 local_context: Mapping[str, Any] = None,
+                 conditions: ConditionCache = None) -> bool:
+        if not self.condition:
+            return True
+
+        if conditions is not None:
+            return bool(conditions.value(self.condition))
+
+        # Locals shadow globals, as with eval(condition, globals, locals); with
+        # no globals given, conditions see this module's, as eval() did
+        if global_context is None:
+            global_context = globals()
+        namespace = ChainMap(*(ctx for ctx in (local_context, global_context) if ctx is not None))
+        return bool(evaluator(self.condition)(namespace))
 
     @abstractmethod
     def as_dict(self) -> dict[str, Any]:
@@ -65,8 +83,9 @@ class DlgChoice(DlgNode):
         self.tags = tags or []
         self.target = target
 
-    def as_dict(self) -> dict[str, Any]:
-        return {'text': self.text, 'target': self.target, 'tags': self.tags, 'valid': self.is_valid()}
+    def as_dict(self, conditions: ConditionCache = None) -> dict[str, Any]:
+        return {'text': self.text, 'target': self.target, 'tags': self.tags,
+                'valid': self.is_valid(conditions=conditions)}
 
 
 class DlgChoices(DlgNode):
@@ -75,8 +94,8 @@ class DlgChoices(DlgNode):
         super().__init__(condition='')
         self.choices = choices
 
-    def as_dict(self) -> dict[str, Any]:
-        return {'choices': [choice.as_dict() for choice in self.choices]}
+    def as_dict(self, conditions: ConditionCache = None) -> dict[str, Any]:
+        return {'choices': [choice.as_dict(conditions) for choice in self.choices]}
 
     def __repr__(self) -> str:
         return f'DlgChoices({str(self.choices)})'
@@ -84,16 +103,45 @@ class DlgChoices(DlgNode):
 # %%
 
 
+class DlgScript(NamedTuple):  # pylint: disable=inherit-non-class
+    # Nodes and the index of each label, shared by every DlgPlayer
+    nodes: tuple[DlgNode, ...]
+    labels: Mapping[str, int]
+
+    def session(self, sink: EventSink = None) -> 'DlgPlayer':
+        return DlgPlayer(self, sink)
+
+
+def load(nodes: Sequence[DlgNode]) -> DlgScript:
+    labels: dict[str, int] = {}
+    for i, node in enumerate(nodes):
+        if isinstance(node, DlgLabel):
+            # The first label of a name wins, as the old linear search did
+            labels.setdefault(node.label, i)
+    return DlgScript(tuple(nodes), labels)
+
+
 class DlgPlayer:
+    # Per-playthrough state only; the DlgScript is shared by every player
+    __slots__ = ('script', 'sink', '_index', 'context', 'conditions')
 
-    def __init__(self, nodes: list[DlgNode] = None) -> None:
-        self.nodes = nodes or []
+    def __init__(self, nodes: Union[DlgScript, Sequence[DlgNode]] = None, sink: EventSink = None) -> None:
+        self.script = nodes if isinstance(nodes, DlgScript) else load(nodes or [])
+        self.sink: EventSink = sink if sink is not None else ConsoleSink()
         self._index = 0
-        self._node: Optional[DlgNode] = None
+        # Names a session sets; other reads fall through to this module's
+        # globals, which conditions were evaluated against before sessions
+        # had a namespace of their own
+        self.context: ChainMap[str, Any] = ChainMap({}, globals())
+        self.conditions = ConditionCache(self.context)
+
+    @property
+    def nodes(self) -> tuple[DlgNode, ...]:
+        return self.script.nodes
 
     def current_node(self):
-        if self._index < len(self.nodes):
-            return self.nodes[self._index]
+        if self._index < len(self.script.nodes):
+            return self.script.nodes[self._index]
 
         return None
 
@@ -102,15 +150,19 @@ class DlgPlayer:
         while self.current_node():
             self.exec_node(self.current_node())
 
+        self.sink.emit(Event(E.END))
+        self.sink.flush()
+
     @singledispatchmethod
     def exec_node(self, node: Any):
         raise NotImplementedError
 
     @exec_node.register
     def exec_line(self, line: DlgLine):
-        if line.is_valid():
-            print(f'{line.speaker}: {line.text}')
-            input()
+        if line.is_valid(conditions=self.conditions):
+            event = Event(E.LINE, (line.speaker, line.text))
+            self.sink.emit(event)
+            self.sink.respond(event)
 
         self._index += 1
 
@@ -118,12 +170,14 @@ class DlgPlayer:
     def exec_choices(self, choices: DlgChoices):
         clist = choices.choices
         if clist:
-            for i, choice in enumerate(clist):
-                print(f'{i+1}. {choice.text}')
+            event = Event(E.OPTIONS, tuple((choice.text, choice.is_valid(conditions=self.conditions))
+                                           for choice in clist))
+            self.sink.emit(event)
 
             while True:
-                c = input('Choose: ')
-                if c and c.isnumeric() and 1 <= int(c) <= len(clist):
+                # No reply (a headless sink) takes the first choice
+                c = self.sink.respond(event) or '1'
+                if c.isnumeric() and 1 <= int(c) <= len(clist):
                     break
 
             self._index = self._get_label_index(clist[int(c) - 1].target)
@@ -134,10 +188,10 @@ class DlgPlayer:
     def exec_label(self, label: DlgLabel):
         self._index += 1
 
-        if not label.is_valid():
+        if not label.is_valid(conditions=self.conditions):
             while self.current_node() and not (
                 isinstance(self.current_node(),
-                           DlgLabel) and self.current_node().is_valid()
+                           DlgLabel) and self.current_node().is_valid(conditions=self.conditions)
             ):
                 self._index += 1
 
@@ -145,10 +199,7 @@ class DlgPlayer:
         if not label:
             return self._index + 1
 
-        try:
-            return next(i for i, v in enumerate(self.nodes) if isinstance(v, DlgLabel) and v.label == label)
-        except StopIteration:
-            return len(self.nodes)
+        return self.script.labels.get(label, len(self.script.nodes))
 
 # %%
 
@@ -0,0 +1,366 @@
+# %%
+import ast
+import builtins
+import operator
+from functools import lru_cache
+from types import CodeType
+from typing import Any, Callable, Iterable, Mapping, MutableMapping, Optional
+
+Evaluator = Callable[[Mapping[str, Any]], Any]
+
+# Fallback eval() sees builtins only; script variables come from the namespace.
+# Callers used to pass None, so expressions also saw the globals of the module
+# evaluating them (vm, interpreter); they no longer do, and anything a script
+# needs must be in its namespace.
+GLOBALS: dict[str, Any] = {}
+
+CONSTANT_TYPES = (str, int, float, bool, bytes, type(None))
+
+COMPARE = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b
+}
+
+UNARY = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos
+}
+
+_MISSING = object()
+
+
+class UnsafeExpressionError(ValueError):
+    pass
+
+
+def _constant(value) -> Evaluator:
+    def const(ns):
+        return value
+
+    const.const = value
+    return const
+
+
+def _name(name: str) -> Evaluator:
+    builtin = getattr(builtins, name, _MISSING)
+
+    def load(ns):
+        try:
+            return ns[name]
+        except KeyError:
+            if builtin is not _MISSING:
+                return builtin
+            raise NameError(f"name '{name}' is not defined") from None
+
+    return load
+
+
+def _attribute(value: Evaluator, attr: str) -> Evaluator:
+    def load(ns):
+        return getattr(value(ns), attr)
+
+    return load
+
+
+def _unary(fn, operand: Evaluator) -> Evaluator:
+    def op(ns):
+        return fn(operand(ns))
+
+    return op
+
+
+def _compare(left: Evaluator, ops: list, comparators: list[Evaluator]) -> Evaluator:
+    if len(ops) == 1:
+        fn, right = ops[0], comparators[0]
+
+        def compare(ns):
+            return fn(left(ns), right(ns))
+
+        return compare
+
+    pairs = list(zip(ops, comparators))
+
+    def chain(ns):
+        lhs = left(ns)
+        for fn, right in pairs:
+            rhs = right(ns)
+            result = fn(lhs, rhs)
+            if not result:
+                return result
+            lhs = rhs
+        return result
+
+    return chain
+
+
+def _and(values: list[Evaluator]) -> Evaluator:
+    def op(ns):
+        for value in values:
+            result = value(ns)
+            if not result:
+                return result
+        return result
+
+    return op
+
+
+def _or(values: list[Evaluator]) -> Evaluator:
+    def op(ns):
+        for value in values:
+            result = value(ns)
+            if result:
+                return result
+        return result
+
+    return op
+
+
+CONVERSIONS = {-1: None, ord('s'): str, ord('r'): repr, ord('a'): ascii}
+
+
+def _part(node: ast.AST, safe: bool) -> Evaluator:
+    # A placeholder outside the subset is still compiled only once, on its own
+    try:
+        return _build(node, safe)
+    except TypeError:
+        if safe:
+            raise
+        return _fallback(ast.unparse(node))
+
+
+def _template(node: ast.JoinedStr, safe: bool) -> Evaluator:
+    # f-string as literal segments and placeholders, rendered by one join
+    parts = []
+    for value in node.values:
+        if isinstance(value, ast.Constant):
+            parts.append(_constant(value.value))
+            continue
+
+        expr = _part(value.value, safe)
+        convert = CONVERSIONS[value.conversion]
+        spec = _template(value.format_spec, safe) if value.format_spec else None
+        parts.append(_placeholder(expr, convert, spec))
+
+    if all(hasattr(part, 'const') for part in parts):
+        return _constant(''.join(part.const for part in parts))
+
+    def render(ns):
+        return ''.join([part(ns) for part in parts])
+
+    return render
+
+
+def _placeholder(expr: Evaluator, convert, spec: Optional[Evaluator]) -> Evaluator:
+    if spec is None and convert is None:
+        def fmt(ns):
+            return format(expr(ns))
+
+        return fmt
+
+    def field(ns):
+        value = expr(ns)
+        if convert is not None:
+            value = convert(value)
+        return format(value, spec(ns) if spec is not None else '')
+
+    return field
+
+
+def _build(node: ast.AST, safe: bool) -> Evaluator:
+    # Raises TypeError for any node outside the supported subset
+    if isinstance(node, ast.Constant):
+        return _constant(node.value)
+
+    if isinstance(node, ast.Name):
+        return _name(node.id)
+
+    if isinstance(node, ast.Attribute):
+        if safe and node.attr.startswith('_'):
+            raise TypeError(f'private attribute {node.attr}')
+        return _attribute(_build(node.value, safe), node.attr)
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY:
+        operand = _build(node.operand, safe)
+        if hasattr(operand, 'const'):
+            return _constant(UNARY[type(node.op)](operand.const))
+        return _unary(UNARY[type(node.op)], operand)
+
+    if isinstance(node, ast.Compare) and all(type(op) in COMPARE for op in node.ops):
+        return _compare(_build(node.left, safe),
+                        [COMPARE[type(op)] for op in node.ops],
+                        [_build(c, safe) for c in node.comparators])
+
+    if isinstance(node, ast.BoolOp):
+        values = [_build(v, safe) for v in node.values]
+        return _and(values) if isinstance(node.op, ast.And) else _or(values)
+
+    if isinstance(node, ast.JoinedStr):
+        return _template(node, safe)
+
+    raise TypeError(f'unsupported expression node {type(node).__name__}')
+
+
+def _fallback(src: str) -> Evaluator:
+    code = compile(src, '<expr>', 'eval')
+    if not code.co_names:
+        # Name-free and immutable: safe to evaluate once. One that raises is
+        # left to raise when (if ever) it runs, not when the script loads.
+        try:
+            value = eval(code, {})
+        except Exception:  # pylint: disable=broad-except
+            pass
+        else:
+            if isinstance(value, CONSTANT_TYPES):
+                return _constant(value)
+
+    def evaluate(ns):
+        return eval(code, GLOBALS, ns)
+
+    return evaluate
+
+
+def validate(src: str, mode: str = 'eval', position: tuple[int, int] = (1, 0), filename: str = '<script>') -> ast.AST:
+    # Parses embedded code once at build time. A SyntaxError is re-raised
+    # located in the script, with position giving where src starts.
+    try:
+        return ast.parse(src.strip() if mode == 'eval' else src, filename, mode)
+    except SyntaxError as e:
+        row, col = position
+        line = e.lineno or 1
+        offset = (col if line == 1 else 0) + (e.offset or 1)
+        kind = 'expression' if mode == 'eval' else 'code'
+        raise SyntaxError(f'{e.msg} in {kind} {src!r}', (filename, row + line - 1, offset, e.text)) from None
+
+
+@lru_cache(maxsize=None)
+def evaluator(src: str, safe: bool = False) -> Evaluator:
+    # Returns fn(namespace) -> value. Conditions in the supported subset
+    # become nested closures; anything else falls back to a cached eval()
+    # unless safe is set, in which case it is rejected.
+    node = ast.parse(src.strip(), mode='eval').body
+    try:
+        return _build(node, safe)
+    except TypeError as e:
+        if safe:
+            raise UnsafeExpressionError(f'{src!r}: {e}') from None
+
+    return _fallback(src.strip())
+
+
+@lru_cache(maxsize=None)
+def template(text: str, quoted: bool = False) -> Evaluator:
+    # Renders text as the body of an f-string, parsed once per distinct text.
+    # With quoted, text is a string literal as written in source, quotes
+    # included.
+    return evaluator('f' + (text if quoted else repr(text)))
+
+
+def is_constant(fn: Evaluator) -> bool:
+    return hasattr(fn, 'const')
+
+
+# Statements that can rebind or mutate state without a visible Name store
+_OPAQUE = (ast.Call, ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef,
+           ast.ClassDef, ast.Global, ast.Nonlocal)
+
+
+@lru_cache(maxsize=None)
+def dependencies(src: str) -> Optional[frozenset[str]]:
+    # Names a condition reads, or None if it calls something and so may
+    # depend on state no name records
+    try:
+        tree = ast.parse(src.strip(), mode='eval')
+    except SyntaxError:
+        return None
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            return None
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+
+    return frozenset(names)
+
+
+@lru_cache(maxsize=None)
+def targets(code: str) -> Optional[frozenset[str]]:
+    # Names a statement may rebind, or None if it may change anything
+    try:
+        tree = ast.parse(code, mode='exec')
+    except SyntaxError:
+        return None
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, _OPAQUE):
+            return None
+        if isinstance(node, (ast.Attribute, ast.Subscript)) and not isinstance(node.ctx, ast.Load):
+            return None
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+
+    return frozenset(names)
+
+
+@lru_cache(maxsize=None)
+def code_object(code: str) -> CodeType:
+    return compile(code, '<code>', 'exec')
+
+
+class ConditionCache:
+    # Condition results for one session's namespace. A result is kept until
+    # a write through assign(), exec() or invalidate() touches a name it
+    # reads; writes made to the namespace directly must call invalidate().
+    __slots__ = ('namespace', 'results', 'readers')
+
+    def __init__(self, namespace: MutableMapping[str, Any]) -> None:
+        self.namespace = namespace
+        self.results: dict[str, Any] = {}
+        # Variable name -> sources of the cached conditions reading it
+        self.readers: dict[str, set[str]] = {}
+
+    def value(self, src: str) -> Any:
+        try:
+            return self.results[src]
+        except KeyError:
+            pass
+
+        value = evaluator(src)(self.namespace)
+        names = dependencies(src)
+        if names is not None:
+            self.results[src] = value
+            for name in names:
+                self.readers.setdefault(name, set()).add(src)
+
+        return value
+
+    def assign(self, name: str, value: Any):
+        self.namespace[name] = value
+        self.invalidate((name,))
+
+    def exec(self, code: str, globals_: dict = None):
+        try:
+            exec(code_object(code), GLOBALS if globals_ is None else globals_, self.namespace)
+        finally:
+            self.invalidate(targets(code))
+
+    def invalidate(self, names: Optional[Iterable[str]] = None):
+        # None drops every cached result
+        if names is None:
+            self.results.clear()
+            self.readers.clear()
+            return
+
+        for name in names:
+            for src in self.readers.pop(name, ()):
+                self.results.pop(src, None)
@@ -0,0 +1,181 @@
+# %%
+from bisect import bisect_right
+from tokenize import TokenError
+from typing import Optional
+from tokens import Instruction as I, TokenType as T
+from compiler import Compiler
+from scanner import TokenBuffer, scan_buffer
+
+
+def _is_choice(buffer: TokenBuffer) -> bool:
+    return len(buffer) > 0 and buffer.type(0) is T.STATEMENT and buffer.value(0) == 'choice'
+
+
+def _boundaries(buffer: TokenBuffer) -> list[int]:
+    # Offsets of the lines that start a top-level statement: a token at
+    # indent level 0 right after a NEWLINE or the DEDENTs closing a block.
+    # The first statement is taken to start at 0, with any blank lines or
+    # comments before it.
+    cuts = [0]
+    level = 0
+    fresh = False
+    types, starts = buffer.types, buffer.starts
+    indent, dedent, newline, end = T.INDENT.value, T.DEDENT.value, T.NEWLINE.value, T.END.value
+    for i in range(len(types)):
+        code = types[i]
+        if code == indent:
+            level += 1
+        elif code == dedent:
+            level -= 1
+        elif code == newline:
+            fresh = True
+            continue
+        elif fresh and not level and code != end:
+            cuts.append(starts[i])
+        fresh = fresh and code == dedent
+
+    return cuts
+
+
+def split(source: str, row: int = 0) -> list[tuple[int, TokenBuffer]]:
+    # Cuts source into top-level statements, each scanned on its own and
+    # paired with its offset. Consecutive `choice` statements compile to one
+    # menu, so they stay together. Raises what scanning source would raise.
+    cuts = _boundaries(scan_buffer(source))
+    units: list[tuple[int, TokenBuffer]] = []
+    for start, stop in zip(cuts, [*cuts[1:], len(source)]):
+        buffer = scan_buffer(source[start:stop])
+        buffer.row = row
+        row += source.count('\n', start, stop)
+        if units and _is_choice(buffer) and _is_choice(units[-1][1]):
+            start, first = units.pop()
+            buffer = scan_buffer(source[start:stop])
+            buffer.row = first.row
+
+        units.append((start, buffer))
+
+    return units
+
+
+class LiveScript:
+    # A script kept compiled while it is being edited.
+    #
+    # The source is held as a run of top-level statements, each with its own
+    # TokenBuffer and instructions. Jumps only ever land inside the statement
+    # they belong to, or just past it, and their offsets are relative, so a
+    # statement's instructions are valid wherever they sit and the whole
+    # program is just the statements' instructions in order. edit() re-lexes
+    # and recompiles only the statements an edit touches.
+    #
+    # A statement only records its own length, line count and instruction
+    # count. Where each one starts in the file is a running total, worked out
+    # as far as it is needed and dropped from the first edited statement on,
+    # so an edit costs the statements it redoes, not the ones after them.
+    # source and instructions are joined from the statements when read.
+    #
+    # symbols.resolve works on the whole program; run it on instructions
+    # after editing if slots are wanted.
+
+    def __init__(self, source: str) -> None:
+        self.buffers: list[TokenBuffer] = []
+        self.chunks: list[list[I]] = []
+        self._heights: list[int] = []
+        # Offset, row and first instruction of each statement, then of the
+        # end; entries past _valid are stale
+        self._starts: list[int] = [0]
+        self._rows: list[int] = [0]
+        self._firsts: list[int] = [0]
+        self._valid = 0
+        self._program: Optional[list[I]] = None
+
+        units = split(source)
+        self._splice(0, 0, units, [Compiler().compile(buffer) for _, buffer in units])
+
+    @property
+    def source(self) -> str:
+        return ''.join(buffer.source for buffer in self.buffers)
+
+    @property
+    def starts(self) -> list[int]:
+        self._settle(len(self.buffers))
+        return self._starts[:-1]
+
+    @property
+    def firsts(self) -> list[int]:
+        self._settle(len(self.buffers))
+        return self._firsts[:-1]
+
+    @property
+    def instructions(self) -> list[I]:
+        if self._program is None:
+            self._program = [instr for chunk in self.chunks for instr in chunk]
+        return self._program
+
+    def edit(self, start: int, end: int, text: str):
+        # Replaces source[start:end] with text. If the edited source does not
+        # scan or compile, the error is raised and nothing changes.
+        count = len(self.buffers)
+
+        # Statements [lo, hi) are redone. Text inserted at the very start of
+        # a statement may belong to the one before it (an indented line).
+        lo = max(self._count(start) - 1, 0)
+        if lo and start == self._starts[lo]:
+            lo -= 1
+        hi = max(self._count(end), lo + 1)
+
+        while True:
+            base = self._starts[lo]
+            region = ''.join(buffer.source for buffer in self.buffers[lo:hi])
+            try:
+                units = split(region[:start - base] + text + region[end - base:], self._rows[lo])
+            except TokenError:
+                # An open bracket, string or expression runs into the next
+                # statement; the next statement is then part of the edit
+                if hi == count:
+                    raise
+                hi += 1
+                continue
+
+            # Keep a menu of `choice` statements together across the edges
+            if lo and _is_choice(units[0][1]) and _is_choice(self.buffers[lo - 1]):
+                lo -= 1
+            elif hi < count and _is_choice(units[-1][1]) and _is_choice(self.buffers[hi]):
+                hi += 1
+            else:
+                break
+
+        self._splice(lo, hi, units, [Compiler().compile(buffer) for _, buffer in units])
+
+    def _count(self, offset: int) -> int:
+        # How many statements start at or before offset
+        count = len(self.buffers)
+        while self._valid < count and self._starts[self._valid] <= offset:
+            self._settle(self._valid + 1)
+        return bisect_right(self._starts, offset, 0, min(self._valid + 1, count))
+
+    def _settle(self, upto: int):
+        # Brings the running totals up to date through statement upto, and
+        # with them the row base of each buffer on the way
+        starts, rows, firsts = self._starts, self._rows, self._firsts
+        for j in range(self._valid, upto):
+            buffer = self.buffers[j]
+            buffer.row = rows[j]
+            starts[j + 1] = starts[j] + len(buffer.source)
+            rows[j + 1] = rows[j] + self._heights[j]
+            firsts[j + 1] = firsts[j] + len(self.chunks[j])
+        self._valid = max(self._valid, upto)
+
+    def _splice(self, lo: int, hi: int, units: list[tuple[int, TokenBuffer]], code: list[list[I]]):
+        buffers = [buffer for _, buffer in units]
+        self.buffers[lo:hi] = buffers
+        self.chunks[lo:hi] = code
+        self._heights[lo:hi] = [buffer.source.count('\n') for buffer in buffers]
+
+        # Everything after the edit keeps its tokens and instructions; only
+        # the totals from lo on have to be worked out again
+        stale = [0] * len(units)
+        self._starts[lo + 1:hi + 1] = stale
+        self._rows[lo + 1:hi + 1] = stale
+        self._firsts[lo + 1:hi + 1] = stale
+        self._valid = min(self._valid, lo)
+        self._program = None
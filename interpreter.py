@@ -1,7 +1,10 @@
 # %%
-from typing import cast
+from typing import NamedTuple, Union, cast
 from functools import singledispatchmethod
 import astnodes as N
+from exprs import ConditionCache, template, validate
+from sinks import ConsoleSink, EventSink
+from tokens import EventType as E, Event
 
 
 class DlgData(dict):
@@ -43,49 +46,126 @@ class DlgData(dict):
         self['valid'] = value
 
 
-class Interpreter:
+def validate_tree(root: N.AstNode):
+    # Syntax-checks every expression and code block reachable from root once,
+    # up front, so evaluation never meets a SyntaxError
+    seen = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+
+        validate(node.condition)
+        for tag in node.tags:
+            template(tag)
+        if isinstance(node, N.CodeNode):
+            validate(node.code, 'exec')
+        elif isinstance(node, N.LineNode):
+            validate(node.speaker)
+            validate(node.text)
+
+        stack.extend(node.children)
+
+
+class Tree(NamedTuple):  # pylint: disable=inherit-non-class
+    # Validated dialogue tree, shared by every Interpreter playing it
+    root: N.AstNode
 
-    def __init__(self, root) -> None:
-        self.node = root
+    def session(self, sink: EventSink = None) -> 'Interpreter':
+        return Interpreter(self, sink)
+
+
+def load_tree(root: N.AstNode) -> Tree:
+    validate_tree(root)
+    return Tree(root)
+
+
+class Interpreter:
+    # Per-playthrough state only; the Tree is shared by every session
+    __slots__ = ('tree', 'sink', 'locals', 'conditions', 'dialog', 'options', 'frames', 'wait', 'ended')
+
+    def __init__(self, tree: Union[Tree, N.AstNode], sink: EventSink = None) -> None:
+        if isinstance(tree, N.AstNode):
+            tree = load_tree(tree)
+        self.tree = tree
+        self.sink: EventSink = sink if sink is not None else ConsoleSink(prompt=False)
         self.locals = {}
+        # Expression results, dropped when `$` code writes a name they read
+        self.conditions = ConditionCache(self.locals)
         self.dialog: DlgData = DlgData()
         self.options: list[N.OptionNode] = []
 
-        self.stack: list[N.AstNode] = [root]
+        # Pending nodes as [children, index of next child] frames; entering a
+        # block pushes a frame instead of copying its children
+        self.frames: list[list] = self._start()
         self.wait = False
+        self.ended = False
+
+    @property
+    def stack(self) -> list[N.AstNode]:
+        # Pending nodes in execution order
+        return [node for nodes, i in reversed(self.frames) for node in nodes[i:]]
+
+    def _start(self) -> list[list]:
+        return [[[self.tree.root], 0]]
 
     def run(self):
-        self.stack = [self.node]
-        self.execute(self.stack.pop(0))
+        self.frames = self._start()
+        self.ended = False
+        self.execute(self._pop())
+        self._end()
 
     def _init_nodes(self):
         pass
 
+    def _push(self, nodes: list[N.AstNode]):
+        if nodes:
+            self.frames.append([nodes, 0])
+
+    def _pop(self):
+        frames = self.frames
+        while frames:
+            frame = frames[-1]
+            nodes, i = frame
+            if i < len(nodes):
+                frame[1] = i + 1
+                return nodes[i]
+            frames.pop()
+
+        return None
+
     def execute(self, node: N.AstNode):
-        print(self.stack)
         if self._evaluate(node.condition):
             self._execute(node)
 
     def next(self, idx=-1):
         if self.options:
             if 0 <= idx < len(self.options):
-                self.stack = self.options[idx].children + self.stack
+                self._push(self.options[idx].children)
                 self.options.clear()
             else:
                 return
 
         self.wait = False
-        if self.stack:
-            self.execute(self.stack.pop(0))
+        node = self._pop()
+        if node is not None:
+            self.execute(node)
+        self._end()
+
+    def _end(self):
+        # The dialogue is over once no node is pending and nothing waits on
+        # the user; the sink hears about it once
+        if not (self.frames or self.options or self.wait or self.ended):
+            self.ended = True
+            self.sink.emit(Event(E.END))
 
     def _evaluate(self, expr: str):
-        result = ''
-        try:
-            result = eval(expr, None, self.locals)
-        except SyntaxError:
-            pass
+        return self.conditions.value(expr)
 
-        return result
+    def _render(self, text: str) -> str:
+        return template(text)(self.locals)
 
     @property
     def optionsview(self):
@@ -99,56 +179,65 @@ class Interpreter:
             ))
         return view
 
+    def _emit_line(self):
+        if self.dialog.tags:
+            self.sink.emit(Event(E.TAGS, tuple(self.dialog.tags)))
+        self.sink.emit(Event(E.LINE, (self.dialog.label, self.dialog.text)))
+
+    def _emit_options(self):
+        self.sink.emit(Event(E.OPTIONS, tuple((option.text, option.valid) for option in self.optionsview)))
+
     @singledispatchmethod
     def _execute(self, node):
         raise NotImplementedError
 
     @_execute.register
     def _execute_code(self, node: N.CodeNode):
-        exec(node.code, None, self.locals)
+        self.conditions.exec(node.code)
 
     @_execute.register
     def _execute_optiongroup(self, node: N.OptionGroup):
         for option in node.children:
             self.options.append(cast(N.OptionNode, option))
 
-        for i, option in enumerate(self.optionsview):
-            print(f'{i+1}. {option.text} [{option.valid}]')
+        self._emit_options()
 
     @_execute.register
     def _execute_line(self, node: N.LineNode):
         self.wait = True
         self.dialog.label = self._evaluate(node.speaker)
         self.dialog.text = self._evaluate(node.text)
-        self.dialog.tags = [self._evaluate(f'f"{tag}"') for tag in node.tags]
-        print(f'{self.dialog.label}: {self.dialog.text}')
+        self.dialog.tags = [self._render(tag) for tag in node.tags]
+        self._emit_line()
 
     @_execute.register
     def _execute_block(self, node: N.BlockNode):
-        self.stack = node.children + self.stack
+        self._push(node.children)
 
-        while self.stack and not self.wait:
-            self.execute(self.stack.pop(0))
+        while not self.wait:
+            child = self._pop()
+            if child is None:
+                break
+            self.execute(child)
 
 
 # %%
-c1 = N.CodeNode('abc = 12')
-c2 = N.CodeNode('abc -= 1')
-l1 = N.LineNode('f"Guy{abc}"', 'f"Hello"')
-o1 = N.OptionNode('Do thing 1')
-o2 = N.OptionNode('Do thing 2')
-opts = N.OptionGroup()
-opts.add_child(o1)
-opts.add_child(o2)
-o1.add_child(c2)
-o1.add_child(N.LineNode('f""', 'f"abc is {abc}"'))
-
-l2 = N.LineNode('"Player"', '"Well it\'s over"')
-b1 = N.BlockNode('start', [l1, opts, l2])
-r = N.BlockNode('', [c1, b1])
-l2.add_child(b1)
-
-I = Interpreter(r)
-# %%
-I.run()
-# %%
+if __name__ == '__main__':
+    c1 = N.CodeNode('abc = 12')
+    c2 = N.CodeNode('abc -= 1')
+    l1 = N.LineNode('f"Guy{abc}"', 'f"Hello"')
+    o1 = N.OptionNode('Do thing 1')
+    o2 = N.OptionNode('Do thing 2')
+    opts = N.OptionGroup()
+    opts.add_child(o1)
+    opts.add_child(o2)
+    o1.add_child(c2)
+    o1.add_child(N.LineNode('f""', 'f"abc is {abc}"'))
+
+    l2 = N.LineNode('"Player"', '"Well it\'s over"')
+    b1 = N.BlockNode('start', [l1, opts, l2])
+    r = N.BlockNode('', [c1, b1])
+    l2.add_child(b1)
+
+    I = Interpreter(r)
+    I.run()
@@ -180,13 +180,13 @@ class GeneratedParser(Parser):
         mark = self.mark()
         cut = False
         if (
-            (_tmp_6 := self._tmp_6())
+            (s := self._tmp_6())
             and
             (a := self._loop0_7(),)
             and
             (newline := self.expect('NEWLINE'))
         ):
-            return PyExec ( ' ' . join ( a ) )
+            return PyExec ( ' ' . join ( flatten ( a ) ) , s [ 0 ] . start )
         self.reset(mark)
         if cut: return None
         cut = False
@@ -201,7 +201,7 @@ class GeneratedParser(Parser):
             and
             (dedent := self.expect('DEDENT'))
         ):
-            return PyExec ( '' . join ( line [ len ( i . string ) : ] for line in py_block ) )
+            return PyExec ( '' . join ( line [ len ( i . string ) : ] for line in py_block ) , ( i . start [ 0 ] , len ( i . string ) ) )
         self.reset(mark)
         if cut: return None
         return None
@@ -326,13 +326,13 @@ class GeneratedParser(Parser):
         mark = self.mark()
         cut = False
         if (
-            (literal := self.expect('{'))
+            (a := self.expect('{'))
             and
             (py_terms := self.py_terms())
             and
-            (literal_1 := self.expect('}'))
+            (literal := self.expect('}'))
         ):
-            return PyExpr ( py_terms )
+            return PyExpr ( py_terms , a . start )
         self.reset(mark)
         if cut: return None
         return None
@@ -1,4 +1,5 @@
 import ast
+from exprs import validate
 
 
 def flatten(obj):
@@ -81,17 +82,19 @@ class PyExec(Statement):
 
     _fields = ('code')
 
-    def __init__(self, code):
+    def __init__(self, code, position=(1, 0)):
         super().__init__(body=None)
         self.code = code
+        validate(code, 'exec', position)
 
 
 class PyExpr(ast.AST):
 
     _fields = ('code')
 
-    def __init__(self, code: str) -> None:
+    def __init__(self, code: str, position: tuple[int, int] = (1, 0)) -> None:
         self.code = code
+        validate(code, 'eval', position)
 
     def __repr__(self) -> str:
         return f'{self.__class__.__name__}(code={self.code})'
@@ -2,9 +2,10 @@
 from token import DEDENT, ENDMARKER, INDENT, NEWLINE, STRING
 import tokenize as T
 from functools import singledispatch
-from io import TextIOBase
-from typing import Generator, Iterable, Union
+from io import StringIO, TextIOBase
+from typing import Callable, Iterable, Iterator, Union
 from tokens import Token, TokenType as TT
+from scanner import scan
 
 # %%
 
@@ -48,6 +49,7 @@ _MAP1: dict[tuple[int, str], tuple[TT, str]] = {
     (T.OP, '}'): (TT.OPERATOR, '}'),
     (T.NAME, 'script'): (TT.STATEMENT, 'script'),
     (T.ERRORTOKEN, '$'): (TT.STATEMENT, 'script'),
+    (T.ERRORTOKEN, ' '): (TT.EMPTY, ' '),
     (T.OP, '|'): (TT.OPERATOR, '|'),
     (T.OP, ':'): (TT.OPERATOR, ':'),
     (T.NAME, 'if'): (TT.OPERATOR, 'if'),
@@ -61,6 +63,8 @@ _MAP2: dict[int, TT] = {
     T.INDENT: TT.INDENT,
     T.DEDENT: TT.DEDENT,
     T.NEWLINE: TT.NEWLINE,
+    T.NL: TT.EMPTY,
+    T.COMMENT: TT.EMPTY,
     T.ENDMARKER: TT.END
 }
 
@@ -69,8 +73,12 @@ _MAP2: dict[int, TT] = {
 
 
 def _tokens(instr: str):
-    lines = (s+'\n' for s in instr.split('\n'))
-    return T.generate_tokens(lambda: next(lines))
+    return _read_tokens(StringIO(instr).readline)
+
+
+def _read_tokens(readline: Callable[[], str]):
+    # stdlib tokenize pulls one line per call, so nothing is read ahead
+    return T.generate_tokens(readline)
 
 
 def _map_token(token: T.TokenInfo):
@@ -80,47 +88,61 @@ def _map_token(token: T.TokenInfo):
 
     return Token(*typeval, pos)
 
-def _postprocess(tokens: Iterable[T.TokenInfo]):
-    outtokens: list[Token] = list()
+# %%
 
-    for token in tokens:
-        tk = _map_token(token)
 
-        if (tk.type, tk.value) == (TT.OPERATOR, '{'):
-            pass
-            
+def _record_lines(lines: dict[int, str], token: T.TokenInfo):
+    # token.line holds every physical line the token spans
+    for row, line in enumerate(token.line.splitlines(keepends=True), token.start[0]):
+        lines[row] = line
 
-# %%
 
+def _source(lines: dict[int, str], start: tuple[int, int], end: tuple[int, int]) -> str:
+    (srow, scol), (erow, ecol) = start, end
+    if srow == erow:
+        return lines[srow][scol:ecol]
 
-def _postproc_tokens(tokens: Iterable[Token]):
-    out_tokens: list[Token] = list()
-    code = list()
-    store = False
-    pos = tuple()
+    return ''.join([lines[srow][scol:], *(lines[row] for row in range(srow + 1, erow)), lines[erow][:ecol]])
+
+
+def _expression(brace: T.TokenInfo, tokens: Iterator[T.TokenInfo]) -> Token:
+    # Consumes tokens up to the '}' matching brace and returns the source
+    # between them verbatim, nested braces included
+    lines: dict[int, str] = {}
+    _record_lines(lines, brace)
+    depth = 1
     for token in tokens:
+        if token.end[0] not in lines:
+            _record_lines(lines, token)
 
-        if token.type == TT.OPERATOR and token.value == '{':
-            store = True
-            pos = token.position
-            continue
+        if token.type == T.OP:
+            if token.string == '{':
+                depth += 1
+            elif token.string == '}':
+                depth -= 1
+                if not depth:
+                    return Token(TT.EXPR, _source(lines, brace.end, token.start), brace.start)
+
+    raise T.TokenError('EOF in expression', brace.start)
 
-        if token.type == TT.OPERATOR and token.value == '}':
-            out_tokens.append(Token(TokenType.EXPR, ' '.join(code), pos))
-            store = False
-            code.clear()
-            continue
 
-        if store:
-            code.append(token.value)
-        else:
-            out_tokens.append(token)
+def _postproc_tokens(tokens: Iterable[T.TokenInfo]):
+    # Reference path over stdlib tokenize, checked against scanner.scan in
+    # bench_lexer. One forward pass; only the source lines of an open {...}
+    # are held back
+    tokens = iter(tokens)
+    for token in tokens:
+        if token.type == T.OP and token.string == '{':
+            yield _expression(token, tokens)
+            continue
 
-    return (t for t in out_tokens if t.type != TokenType.EMPTY)
+        tk = _map_token(token)
+        if tk.type != TT.EMPTY:
+            yield tk
 
 
 @singledispatch
-def tokenize(code: Union[str, TextIOBase], raw=False) -> Generator[Union[Token, T.TokenInfo], None, None]:
+def tokenize(code: Union[str, TextIOBase], raw=False) -> Iterator[Union[Token, T.TokenInfo]]:
     raise TypeError('code must be a str or TextIOBase.')
 
 
@@ -129,46 +151,24 @@ def tokenize_str(code: str, raw: bool = False):
     if raw:
         return _tokens(code)
 
-    return _postproc_tokens(_map_token(t) for t in _tokens(code))
+    return scan(StringIO(code).readline)
 
 
 @tokenize.register
 def tokenize_file(file: TextIOBase, raw: bool = False):
-    code = file.read()
-    return tokenize(code, raw)
+    if raw:
+        return _read_tokens(file.readline)
 
+    return scan(file.readline)
 
-# %%
-tkns = []
-with open('test2.zds', 'r') as f:
-    tkns = list(tokenize_file(f, True))
 
 # %%
+if __name__ == '__main__':
+    tkns = []
+    with open('test2.zds', 'r') as f:
+        tkns = list(tokenize_file(f, True))
 
-def get_expr(tokens: list[T.TokenInfo]):
-    strings = list()
-    level = 1
-
-    while level:
-        strings.append(tokens.pop(0).string)
-        level += 1 if strings[-1] == '{' else -1 if strings[-1] == '}' else 0
-
-    return ('EXPR', ' '.join(strings[:-1]))
-        
-
-
-def process(tokens: list[T.TokenInfo]):
-    _tokens = tokens.copy()
-    out_tokens = list()
-
-    while _tokens:
-        curr_token = _tokens.pop(0)
-        out_tokens.append(get_expr(_tokens) if curr_token.string == '{' else curr_token)
-
-    return out_tokens
-
-# %%
-codestr = 'line "Nora":\n\t {x < 234 and f"hi {player}"}'
+    codestr = 'line "Nora":\n\t {x < 234 and f"hi {player}"}'
 
-process(list(_tokens(codestr)))
+    list(tokenize(codestr))
 # %%
@@ -0,0 +1,190 @@
+# %%
+from ast import literal_eval
+from collections import Counter
+from typing import Iterable, Optional
+from tokens import InstructionType as IType, Instruction as I
+
+# Instructions whose last arg is a jump offset relative to themselves
+JUMPS = {IType.OP_JUMP, IType.OP_JUMP_FALSE, IType.ADD_OPTION, IType.OP_EXPR_JUMP_FALSE,
+         IType.OP_TEST_SLOT_JUMP_FALSE}
+
+
+def _constant(expr) -> tuple[bool, object]:
+    if not isinstance(expr, str):
+        return False, None
+    try:
+        return True, literal_eval(expr)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return False, None
+
+
+class _Code:
+    # Working copy of a chunk with absolute jump targets and tombstones
+
+    def __init__(self, chunk: Iterable[tuple[IType, tuple]]) -> None:
+        self.ops: list[list] = [[itype, list(args)] for itype, args in chunk]
+        self.removed: list[bool] = [False] * len(self.ops)
+        for i, (itype, args) in enumerate(self.ops):
+            if itype in JUMPS:
+                args[-1] += i
+
+    def live(self, i: int) -> int:
+        # First surviving index at or after i
+        while i < len(self.ops) and self.removed[i]:
+            i += 1
+        return i
+
+    def next(self, i: int) -> int:
+        return self.live(i + 1)
+
+    def get(self, i: int) -> Optional[IType]:
+        return self.ops[i][0] if i < len(self.ops) else None
+
+    def targets(self) -> set[int]:
+        out = set()
+        for i, (itype, args) in enumerate(self.ops):
+            if self.removed[i]:
+                continue
+            if itype in JUMPS:
+                out.add(self.live(args[-1]))
+            elif itype == IType.LABEL:
+                out.add(self.next(i))
+        return out
+
+    def assemble(self) -> list[I]:
+        newidx = [0] * (len(self.ops) + 1)
+        count = 0
+        for i in range(len(self.ops) + 1):
+            newidx[i] = count
+            if i < len(self.ops) and not self.removed[i]:
+                count += 1
+
+        out = []
+        for i, (itype, args) in enumerate(self.ops):
+            if self.removed[i]:
+                continue
+            if itype in JUMPS:
+                args = [*args[:-1], newidx[self.live(args[-1])] - newidx[i]]
+            out.append(I(itype, tuple(args)))
+
+        return out
+
+
+def _fold(code: _Code, report: Counter):
+    targets = code.targets()
+    for i, (itype, args) in enumerate(code.ops):
+        if code.removed[i]:
+            continue
+
+        if itype == IType.ADD_OPTION:
+            ok, value = _constant(args[1])
+            if ok:
+                args[1] = bool(value)
+                report['constant option conditions'] += 1
+
+        elif itype == IType.OP_EXPR and code.get(j := code.next(i)) == IType.OP_JUMP_FALSE and j not in targets:
+            ok, value = _constant(args[0])
+            if not ok:
+                continue
+            if value:
+                code.removed[i] = True
+            else:
+                code.ops[i] = [IType.OP_JUMP, [code.ops[j][1][0]]]
+            code.removed[j] = True
+            report['constant conditions'] += 1
+
+
+def _thread(code: _Code, report: Counter):
+    for i, (itype, args) in enumerate(code.ops):
+        if code.removed[i] or itype not in JUMPS:
+            continue
+
+        target, seen = code.live(args[-1]), {i}
+        while code.get(target) == IType.OP_JUMP and target not in seen:
+            seen.add(target)
+            target = code.live(code.ops[target][1][0])
+
+        if target != code.live(args[-1]):
+            report['jumps threaded'] += 1
+        args[-1] = target
+
+        if itype == IType.OP_JUMP and target == code.next(i):
+            code.removed[i] = True
+            report['jumps to next removed'] += 1
+
+
+def _successors(code: _Code, i: int, labels: dict[str, int]) -> list[int]:
+    itype, args = code.ops[i]
+    if itype == IType.OP_JUMP:
+        return [code.live(args[0])]
+    if itype == IType.EXEC_GOTO:
+        return [labels[args[0]]] if args[0] in labels else []
+    if itype == IType.EXEC_OPTIONS:
+        # Only left through choose(), whose targets come from ADD_OPTION
+        return []
+    if itype in JUMPS:
+        return [code.next(i), code.live(args[-1])]
+    return [code.next(i)]
+
+
+def _prune(code: _Code, report: Counter):
+    labels = {args[0]: code.next(i) for i, (itype, args) in enumerate(code.ops)
+              if itype == IType.LABEL and not code.removed[i]}
+    roots = [code.live(0)] + [i for i, (itype, _) in enumerate(code.ops)
+                              if itype == IType.LABEL and not code.removed[i]]
+
+    reached = set()
+    stack = roots
+    while stack:
+        i = stack.pop()
+        if i >= len(code.ops) or i in reached:
+            continue
+        reached.add(i)
+        stack.extend(_successors(code, i, labels))
+
+    for i in range(len(code.ops)):
+        if not code.removed[i] and i not in reached:
+            code.removed[i] = True
+            report['dead instructions removed'] += 1
+
+
+def _fuse(code: _Code, report: Counter):
+    targets = code.targets()
+    for i, (itype, args) in enumerate(code.ops):
+        if code.removed[i] or itype not in (IType.OP_EXPR, IType.OP_TEST_SLOT):
+            continue
+
+        j = code.next(i)
+        if j in targets:
+            continue
+
+        if itype == IType.OP_TEST_SLOT:
+            if code.get(j) == IType.OP_JUMP_FALSE:
+                code.ops[i] = [IType.OP_TEST_SLOT_JUMP_FALSE, [*args, code.ops[j][1][0]]]
+                code.removed[j] = True
+                report['slot test + jump_false fused'] += 1
+
+        elif code.get(j) == IType.OP_JUMP_FALSE:
+            code.ops[i] = [IType.OP_EXPR_JUMP_FALSE, [args[0], code.ops[j][1][0]]]
+            code.removed[j] = True
+            report['expr + jump_false fused'] += 1
+
+        elif code.get(j) == IType.OP_EXPR and code.get(k := code.next(j)) == IType.EXEC_LINE and k not in targets:
+            code.ops[i] = [IType.EXEC_EXPR_LINE, [args[0], code.ops[j][1][0]]]
+            code.removed[j] = code.removed[k] = True
+            report['expr + expr + line fused'] += 1
+
+
+def optimize(chunk: Iterable[tuple[IType, tuple]]) -> tuple[list[I], Counter]:
+    report: Counter = Counter()
+    code = _Code(chunk)
+
+    _fold(code, report)
+    _thread(code, report)
+    _prune(code, report)
+    _fuse(code, report)
+
+    out = code.assemble()
+    report['instructions before'] = len(code.ops)
+    report['instructions after'] = len(out)
+    return out, report
@@ -0,0 +1,517 @@
+# %%
+import re
+from array import array
+from bisect import bisect_right
+from functools import singledispatch
+from io import StringIO, TextIOBase
+from tokenize import TokenError
+from typing import Callable, Iterator, Optional, Union
+from tokens import Token, TokenType as TT
+
+# Lexemes the dialogue language gives a meaning of its own. Names and
+# operators never collide, so one lookup on the matched text classifies
+# either; anything missing is a plain NAME or OPERATOR.
+LEXEMES: dict[str, tuple[TT, str]] = {
+    'label': (TT.STATEMENT, 'label'),
+    '@': (TT.STATEMENT, 'label'),
+    'goto': (TT.STATEMENT, 'goto'),
+    '->': (TT.STATEMENT, 'goto'),
+    'line': (TT.STATEMENT, 'line'),
+    '-': (TT.STATEMENT, 'line'),
+    'choice': (TT.STATEMENT, 'choice'),
+    '*': (TT.STATEMENT, 'choice'),
+    'map': (TT.STATEMENT, 'map'),
+    '**': (TT.STATEMENT, 'map'),
+    'script': (TT.STATEMENT, 'script'),
+    '$': (TT.STATEMENT, 'script'),
+    'as': (TT.OPERATOR, 'as'),
+    '=>': (TT.OPERATOR, 'as'),
+    'if': (TT.OPERATOR, 'if'),
+}
+
+# Token types as stored in a TokenBuffer: the TokenType values, which
+# count up from 1, index TYPES
+TYPES: tuple[Optional[TT], ...] = (None, *TT)
+
+_KINDS: dict[str, int] = {lexeme: tt.value for lexeme, (tt, _) in LEXEMES.items()}
+_CONSTANT_CODE, _OPERATOR_CODE, _NAME_CODE, _EXPR_CODE = TT.CONSTANT.value, TT.OPERATOR.value, TT.NAME.value, TT.EXPR.value
+_INDENT_CODE, _DEDENT_CODE, _NEWLINE_CODE = TT.INDENT.value, TT.DEDENT.value, TT.NEWLINE.value
+_END_CODE, _UNKNOWN_CODE = TT.END.value, TT.UNKNOWN.value
+
+_PREFIX = r'(?:[bB][rR]?|[rR][bBfF]?|[fF][rR]?|[uU])?'
+_SINGLE = r"'(?!'')[^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'" + r'|"(?!"")[^"\\\r\n]*(?:\\.[^"\\\r\n]*)*"'
+_TRIPLE = r"'''[^'\\]*(?:(?:\\[\s\S]|'(?!''))[^'\\]*)*'''" + r'|"""[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*"""'
+_NUMBER = (r'0[xX](?:_?[0-9a-fA-F])+|0[bB](?:_?[01])+|0[oO](?:_?[0-7])+'
+           r'|(?:(?:\d(?:_?\d)*)?\.\d(?:_?\d)*|\d(?:_?\d)*\.?)(?:[eE][-+]?\d(?:_?\d)*)?[jJ]?')
+_OPERATOR = (r'\*\*=?|//=?|>>=?|<<=?|->|=>|:=|\.\.\.|[-+*/%&|^@<>=!]='
+             r'|[-+*/%&|^@<>=~:;,.()\[\]}$]')
+
+# Alternatives are tried in order at each position: quoted strings before
+# names, so prefixes like f"..." stay one token, numbers before operators
+_MASTER = re.compile('|'.join([
+    r'(?P<WS>[ \t\f]+)',
+    rf'(?P<STRING>{_PREFIX}(?:{_SINGLE}))',
+    rf'(?P<TRIPLE>{_PREFIX}(?:\'\'\'|"""))',
+    r'(?P<NAME>[^\W\d]\w*)',
+    rf'(?P<NUMBER>{_NUMBER})',
+    r'(?P<NEWLINE>\r?\n)',
+    r'(?P<LBRACE>\{)',
+    rf'(?P<OPERATOR>{_OPERATOR})',
+    r'(?P<COMMENT>#[^\r\n]*)',
+    r'(?P<CONTINUE>\\\r?\n)',
+    r'(?P<UNKNOWN>.)'
+]))
+
+# Pieces of an embedded expression: only braces outside strings and
+# comments count towards nesting
+_EXPR = re.compile('|'.join([
+    r'[^{}\'"#\\]+',
+    _TRIPLE,
+    _SINGLE,
+    r'\\[\s\S]',
+    r'#[^\r\n]*(?=\n)',
+    r'(?P<OPEN>\{)',
+    r'(?P<CLOSE>\})'
+]))
+
+_TRIPLE_END = {
+    "'''": re.compile(r"[^'\\]*(?:(?:\\[\s\S]|'(?!''))[^'\\]*)*'''"),
+    '"""': re.compile(r'[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*"""')
+}
+
+_BLANK = re.compile(r'[ \t\f]*(?:#[^\r\n]*)?(?:\r?\n)?$')
+_INDENT = re.compile(r'[ \t\f]*')
+
+_OPEN = frozenset('([')
+_CLOSE = frozenset(')]')
+
+
+def _width(indent: str) -> int:
+    # Tab stops every 8 columns and form feed resets, as in Python
+    if '\t' not in indent and '\f' not in indent:
+        return len(indent)
+
+    col = 0
+    for char in indent:
+        col = (col // 8 + 1) * 8 if char == '\t' else 0 if char == '\f' else col + 1
+    return col
+
+
+class Lines:
+    # The scanner's view of its input: the text being scanned (one physical
+    # line, or several while a multi-line token is open), the row and source
+    # offset it starts at, and the offset every line read so far starts at
+    __slots__ = ('text', 'base', 'row', 'starts')
+
+    def __init__(self) -> None:
+        self.text: str = ''
+        self.base: int = 0
+        self.row: int = 0
+        self.starts: array = array('I')
+
+
+def _scan(readline: Callable[[], str], lines: Lines) -> Iterator[tuple[int, int, int]]:
+    # One regex match per token over the current physical line, yielding
+    # (type code, start, end) as offsets into the whole source. lines is
+    # current whenever a token is yielded. Triple-quoted strings and {...}
+    # expressions pull further lines until they close, then scanning resumes
+    # on the last line they touched.
+    match = _MASTER.match
+    kinds = _KINDS.get
+    starts = lines.starts
+    indents = [0]
+    depth = 0
+    row = 0
+    base = 0
+    joined = False
+    pending = False
+    line = ''
+
+    while True:
+        nextline = readline()
+        if not nextline:
+            break
+
+        base += len(line)
+        line = nextline
+        row += 1
+        starts.append(base)
+        lines.text, lines.base, lines.row = line, base, row
+
+        pos = 0
+        if not depth and not joined:
+            if _BLANK.match(line):
+                continue
+
+            pos = _INDENT.match(line).end()
+            col = _width(line[:pos])
+            if col > indents[-1]:
+                indents.append(col)
+                yield _INDENT_CODE, base, base + pos
+
+            while col < indents[-1]:
+                indents.pop()
+                yield _DEDENT_CODE, base + pos, base + pos
+
+            if col != indents[-1]:
+                raise IndentationError('unindent does not match any outer indentation level',
+                                       ('<tokenize>', row, pos, line))
+
+        joined = False
+        end = len(line)
+        while pos < end:
+            m = match(line, pos)
+            kind = m.lastgroup
+            start, pos = pos, m.end()
+
+            if kind == 'WS' or kind == 'COMMENT':
+                continue
+
+            if kind == 'NAME' or kind == 'OPERATOR':
+                value = m.group()
+                if value in _OPEN:
+                    depth += 1
+                elif value in _CLOSE:
+                    depth -= 1
+                yield kinds(value) or (_NAME_CODE if kind == 'NAME' else _OPERATOR_CODE), base + start, base + pos
+
+            elif kind == 'STRING' or kind == 'NUMBER':
+                yield _CONSTANT_CODE, base + start, base + pos
+
+            elif kind == 'NEWLINE':
+                if not depth:
+                    pending = False
+                    yield _NEWLINE_CODE, base + start, base + pos
+                continue
+
+            elif kind == 'CONTINUE':
+                joined = True
+                continue
+
+            elif kind == 'LBRACE' or kind == 'TRIPLE':
+                if kind == 'LBRACE':
+                    pos, line, added = _expression(readline, line, pos, (row, start))
+                    lines.text = line
+                    yield _EXPR_CODE, base + start, base + pos
+                else:
+                    pos, line, added = _triple(readline, line, pos, (row, start))
+                    lines.text = line
+                    yield _CONSTANT_CODE, base + start, base + pos
+
+                # Carry on from the last physical line the token spans
+                for _ in range(added):
+                    lstart = line.index('\n') + 1
+                    line, pos = line[lstart:], pos - lstart
+                    base += lstart
+                    row += 1
+                    starts.append(base)
+                lines.text, lines.base, lines.row = line, base, row
+                end = len(line)
+
+            else:
+                yield _UNKNOWN_CODE, base + start, base + pos
+
+            pending = True
+
+    if depth or joined:
+        raise TokenError('EOF in multi-line statement', (row + 1, 0))
+
+    base += len(line)
+    if pending:
+        yield _NEWLINE_CODE, base, base
+
+    starts.append(base)
+    lines.text, lines.base, lines.row = '', base, row + 1
+    for _ in indents[1:]:
+        yield _DEDENT_CODE, base, base
+
+    yield _END_CODE, base, base
+
+
+def _value(text: str, code: int) -> str:
+    # Token value from its source text: the inside of an {...} expression,
+    # the canonical spelling of a dialogue lexeme, else the text itself
+    if code == _EXPR_CODE:
+        return text[1:-1]
+
+    known = LEXEMES.get(text)
+    return known[1] if known is not None else text
+
+
+class TokenStream:
+    # Tokens scanned from readline one at a time, as they are asked for. The
+    # source is kept from the start of the current logical line only, so the
+    # text of the tokens on that line can still be sliced; code, start and
+    # end describe the token returned last.
+    __slots__ = ('code', 'start', 'end', '_tokens', '_lines', '_text', '_base', '_cut')
+
+    def __init__(self, readline: Callable[[], str]) -> None:
+        self.code: int = 0
+        self.start: int = 0
+        self.end: int = 0
+        self._lines = Lines()
+        self._text: str = ''
+        self._base: int = 0
+        # Offset the kept text can be cut back to once the next token is read
+        self._cut: int = 0
+
+        def read() -> str:
+            line = readline()
+            self._text += line
+            return line
+
+        self._tokens = _scan(read, self._lines)
+
+    def __iter__(self) -> Iterator[Token]:
+        return self
+
+    def __next__(self) -> Token:
+        if self._cut > self._base:
+            self._text = self._text[self._cut - self._base:]
+            self._base = self._cut
+
+        code, start, end = next(self._tokens)
+        self.code, self.start, self.end = code, start, end
+        if code == _NEWLINE_CODE:
+            self._cut = end
+
+        lines = self._lines
+        return Token(TYPES[code], _value(self.source(start, end), code), (lines.row, start - lines.base))
+
+    def source(self, start: int, end: int) -> str:
+        return self._text[start - self._base:end - self._base]
+
+
+def scan(readline: Callable[[], str]) -> TokenStream:
+    return TokenStream(readline)
+
+
+class TokenBuffer:
+    # Scanned tokens as parallel arrays of type code and start/end offset
+    # into the source. Values are sliced and positions worked out from the
+    # line-start index only when asked for.
+
+    def __init__(self, source: str, starts: array = None) -> None:
+        self.source = source
+        self.types: array = array('B')
+        self.starts: array = array('I')
+        self.ends: array = array('I')
+        self.lines: array = starts if starts is not None else array('I')
+        # Rows above the first line of source, when it is part of a file
+        self.row: int = 0
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def __iter__(self) -> Iterator[Token]:
+        return map(self.token, range(len(self)))
+
+    def type(self, index: int) -> TT:
+        return TYPES[self.types[index]]
+
+    def value(self, index: int) -> str:
+        return _value(self.source[self.starts[index]:self.ends[index]], self.types[index])
+
+    def position(self, index: int) -> tuple[int, int]:
+        offset = self.starts[index]
+        row = bisect_right(self.lines, offset)
+        if offset == self.ends[index] and self.types[index] == _NEWLINE_CODE:
+            # The empty NEWLINE closing a source with no final newline sits
+            # at the end of the last line, not on the row after it
+            row = bisect_right(self.lines, offset - 1)
+        return self.row + row, offset - self.lines[row - 1]
+
+    def token(self, index: int) -> Token:
+        return Token(self.type(index), self.value(index), self.position(index))
+
+    def cursor(self) -> 'Cursor':
+        return Cursor(self)
+
+
+class Cursor:
+    # Reads a TokenBuffer front to back; index counts the tokens consumed.
+    # type is None once every token has been read.
+    __slots__ = ('buffer', 'index', '_types')
+
+    def __init__(self, buffer: TokenBuffer) -> None:
+        self.buffer = buffer
+        self.index: int = 0
+        self._types = buffer.types
+
+    @property
+    def type(self) -> Optional[TT]:
+        return TYPES[self._types[self.index]] if self.index < len(self._types) else None
+
+    @property
+    def value(self) -> str:
+        return self.buffer.value(self.index)
+
+    @property
+    def position(self) -> tuple[int, int]:
+        return self.buffer.position(self.index)
+
+    @property
+    def start(self) -> int:
+        return self.buffer.starts[self.index]
+
+    @property
+    def end(self) -> int:
+        return self.buffer.ends[self.index]
+
+    def source(self, start: int, end: int) -> str:
+        # Source text between two offsets of tokens already read
+        return self.buffer.source[start:end]
+
+    def token(self) -> Optional[Token]:
+        return self.buffer.token(self.index) if self.index < len(self._types) else None
+
+    def advance(self):
+        self.index += 1
+
+
+class StreamCursor:
+    # The Cursor interface over a TokenStream, pulling one token at a time so
+    # the compiler can start before the source has been read in full
+    __slots__ = ('stream', 'index', 'start', 'end', '_current')
+
+    def __init__(self, stream: TokenStream) -> None:
+        self.stream = stream
+        self.index: int = 0
+        self._read()
+
+    def _read(self):
+        self._current = next(self.stream, None)
+        self.start = self.stream.start
+        self.end = self.stream.end
+
+    @property
+    def type(self) -> Optional[TT]:
+        return self._current.type if self._current is not None else None
+
+    @property
+    def value(self) -> str:
+        return self._current.value
+
+    @property
+    def position(self) -> tuple[int, int]:
+        return self._current.position
+
+    def source(self, start: int, end: int) -> str:
+        # Only offsets on the logical line being read are still kept
+        return self.stream.source(start, end)
+
+    def token(self) -> Optional[Token]:
+        return self._current
+
+    def advance(self):
+        self.index += 1
+        self._read()
+
+
+def _fill(buffer: TokenBuffer, tokens: Iterator[tuple[int, int, int]]) -> TokenBuffer:
+    types, starts, ends = buffer.types.append, buffer.starts.append, buffer.ends.append
+    for code, start, end in tokens:
+        types(code)
+        starts(start)
+        ends(end)
+
+    return buffer
+
+
+@singledispatch
+def scan_buffer(code: Union[str, TextIOBase]) -> TokenBuffer:
+    raise TypeError('code must be a str or TextIOBase.')
+
+
+@scan_buffer.register
+def scan_buffer_str(code: str) -> TokenBuffer:
+    lines = Lines()
+    return _fill(TokenBuffer(code, lines.starts), _scan(StringIO(code).readline, lines))
+
+
+@scan_buffer.register
+def scan_buffer_file(file: TextIOBase) -> TokenBuffer:
+    # Scanned as it is read. Values are sliced from the source later, so the
+    # lines read are kept and joined at the end.
+    lines = Lines()
+    text: list[str] = []
+
+    def readline() -> str:
+        line = file.readline()
+        text.append(line)
+        return line
+
+    buffer = _fill(TokenBuffer('', lines.starts), _scan(readline, lines))
+    buffer.source = ''.join(text)
+    return buffer
+
+
+@singledispatch
+def cursor(code: Union[TokenBuffer, TokenStream, str, TextIOBase]) -> Union[Cursor, StreamCursor]:
+    raise TypeError('code must be a TokenBuffer, TokenStream, str or TextIOBase.')
+
+
+@cursor.register
+def cursor_buffer(code: TokenBuffer) -> Cursor:
+    return code.cursor()
+
+
+@cursor.register
+def cursor_stream(code: TokenStream) -> StreamCursor:
+    return StreamCursor(code)
+
+
+@cursor.register
+def cursor_str(code: str) -> Cursor:
+    return scan_buffer(code).cursor()
+
+
+@cursor.register
+def cursor_file(code: TextIOBase) -> StreamCursor:
+    return StreamCursor(scan(code.readline))
+
+
+def _extend(readline: Callable[[], str], text: str, msg: str, position: tuple[int, int]) -> str:
+    more = readline()
+    if not more:
+        raise TokenError(msg, position)
+    return text + more
+
+
+def _expression(readline: Callable[[], str], text: str, pos: int, position: tuple[int, int]):
+    # Returns the offset just past the '}' matching the brace before pos, the
+    # text read so far and how many lines were added to it
+    match = _EXPR.match
+    depth = 1
+    added = 0
+    while True:
+        m = match(text, pos)
+        if m is None:
+            # Ran off the end of the text mid-piece, or mid-line at EOF
+            text = _extend(readline, text, 'EOF in expression', position)
+            added += 1
+            continue
+
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == 'OPEN':
+            depth += 1
+        elif kind == 'CLOSE':
+            depth -= 1
+            if not depth:
+                return pos, text, added
+        elif pos == len(text):
+            text = _extend(readline, text, 'EOF in expression', position)
+            added += 1
+
+
+def _triple(readline: Callable[[], str], text: str, pos: int, position: tuple[int, int]):
+    closing = _TRIPLE_END[text[pos - 3:pos]]
+    added = 0
+    while True:
+        m = closing.match(text, pos)
+        if m is not None:
+            return m.end(), text, added
+
+        text = _extend(readline, text, 'EOF in multi-line string', position)
+        added += 1
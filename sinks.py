@@ -0,0 +1,111 @@
+# %%
+import json
+from typing import IO, Optional
+from tokens import EventType as E, Event
+
+
+class EventSink:
+    # Receives every Event a player produces. respond() is asked for the
+    # user's reply where a player would wait for one: the raw text typed, or
+    # None to take the default (continue, or the first valid option).
+
+    def emit(self, event: Event):
+        raise NotImplementedError
+
+    def respond(self, event: Event) -> Optional[str]:
+        return None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ConsoleSink(EventSink):
+    # Interactive terminal output, as the players used to print it
+
+    def __init__(self, prompt: bool = True) -> None:
+        self.prompt = prompt
+
+    def emit(self, event: Event):
+        if event.type is E.LINE:
+            print(f'{event.args[0]}: {event.args[1]}')
+        elif event.type is E.OPTIONS:
+            for i, (text, valid) in enumerate(event.args):
+                print(f'{i+1}. {text} [{valid}]')
+        elif event.type is E.END:
+            print('END')
+
+    def respond(self, event: Event) -> Optional[str]:
+        if not self.prompt:
+            return None
+        return input('Choose: ' if event.type is E.OPTIONS else '')
+
+
+class NullSink(EventSink):
+
+    def emit(self, event: Event):
+        pass
+
+
+class ListSink(EventSink):
+    # Keeps the events themselves, for tests and tooling
+
+    def __init__(self) -> None:
+        self.events: list[Event] = []
+
+    def emit(self, event: Event):
+        self.events.append(event)
+
+
+class NDJSONSink(EventSink):
+    # One JSON record per event, e.g. {"type":"LINE","args":["Bob","Hi"]},
+    # buffered and written in bulk every `buffer` events and on flush()
+
+    def __init__(self, stream: IO[str], buffer: int = 4096) -> None:
+        self.stream = stream
+        self.buffer = buffer
+        self._records: list[str] = []
+        self._encode = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=str).encode
+
+    def emit(self, event: Event):
+        self._records.append(self._encode({'type': event.type.name, 'args': event.args}))
+        if len(self._records) >= self.buffer:
+            self.flush()
+
+    def flush(self):
+        if self._records:
+            self._records.append('')
+            self.stream.write('\n'.join(self._records))
+            self._records.clear()
+        self.stream.flush()
+
+
+def play(session, sink: EventSink) -> None:
+    # Drives a vm.Session to the end, routing its events to sink. Replying
+    # 'EXIT' to a line stops playback, as in dlg.player.DlgPlayer.
+    events = session.execute()
+    event = next(events)
+    while True:
+        sink.emit(event)
+        if event.type is E.END:
+            return
+
+        choice = None
+        if event.type is E.OPTIONS:
+            valid = [i for i, (_, ok) in enumerate(event.args) if ok]
+            if not valid:
+                return
+            reply = sink.respond(event)
+            choice = int(reply) - 1 if reply and reply.isnumeric() and int(reply) - 1 in valid else valid[0]
+        elif event.type is E.LINE and sink.respond(event) == 'EXIT':
+            return
+
+        event = events.send(choice)
@@ -0,0 +1,66 @@
+# %%
+from copy import deepcopy
+from types import MappingProxyType
+from typing import Any, Iterator, Mapping
+
+# Values that can be shared between sessions without copying
+IMMUTABLE_TYPES = (str, int, float, bool, complex, bytes, tuple, frozenset, type(None))
+
+
+def freeze(defaults: Mapping[str, Any]) -> Mapping[str, Any]:
+    return defaults if isinstance(defaults, MappingProxyType) else MappingProxyType(dict(defaults))
+
+
+class VarStore(dict):
+    # Session variables as a small overlay on shared, read-only defaults.
+    #
+    # The dict itself only holds what this session has written; reads of
+    # other names fall through to the defaults via __missing__, which eval()
+    # and exec() honor for a dict subclass passed as locals. Mutable default
+    # values are copied into the overlay on first read so one session can
+    # never modify another's.
+    __slots__ = ('defaults',)
+
+    def __init__(self, defaults: Mapping[str, Any] = None, **overrides) -> None:
+        super().__init__(**overrides)
+        # A plain dict is wrapped, not copied: starting a session is O(1)
+        if not isinstance(defaults, MappingProxyType):
+            defaults = MappingProxyType(defaults if defaults is not None else {})
+        self.defaults = defaults
+
+    def __missing__(self, key: str) -> Any:
+        value = self.defaults[key]
+        if not isinstance(value, IMMUTABLE_TYPES):
+            value = deepcopy(value)
+            self[key] = value
+        return value
+
+    def __contains__(self, key) -> bool:
+        return dict.__contains__(self, key) or key in self.defaults
+
+    def get(self, key, default=None) -> Any:
+        return self[key] if key in self else default
+
+    def keys(self):
+        return (dict.keys(self) | self.defaults.keys())
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def overlay(self) -> dict[str, Any]:
+        return dict(dict.items(self))
+
+    def flatten(self) -> dict[str, Any]:
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.overlay()}, defaults={len(self.defaults)})'
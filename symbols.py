@@ -0,0 +1,196 @@
+# %%
+import ast
+from typing import Iterable, NamedTuple, Optional
+from tokens import InstructionType as IType, Instruction as I
+
+# Comparisons a slot test can do without eval; keys are operator names
+# stored in the instruction, so chunks stay plain data
+COMPARE_OPS = {
+    ast.Eq: 'eq',
+    ast.NotEq: 'ne',
+    ast.Lt: 'lt',
+    ast.LtE: 'le',
+    ast.Gt: 'gt',
+    ast.GtE: 'ge',
+    ast.Is: 'is_',
+    ast.IsNot: 'is_not'
+}
+
+# `literal <op> name` is rewritten as `name <mirror> literal`
+MIRROR = {'eq': 'eq', 'ne': 'ne', 'lt': 'gt', 'le': 'ge', 'gt': 'lt', 'ge': 'le', 'is_': 'is_', 'is_not': 'is_not'}
+
+# Plain, not in-place, operators: the constant operand lives in the shared
+# Script, so nothing it touches may be mutated
+AUG_OPS = {
+    ast.Add: 'add',
+    ast.Sub: 'sub',
+    ast.Mult: 'mul',
+    ast.Div: 'truediv',
+    ast.FloorDiv: 'floordiv',
+    ast.Mod: 'mod'
+}
+
+# Literal types that can be baked into a shared Script
+IMMUTABLE_LITERALS = (int, float, complex, str, bytes, bool, type(None))
+
+
+class SymbolTable(NamedTuple):  # pylint: disable=inherit-non-class
+    # Names given a fixed slot, in slot order, and names that must stay in
+    # the dict namespace because some code using them could not be analyzed
+    slots: tuple[str, ...]
+    dynamic: frozenset[str]
+
+    def index(self, name: str) -> Optional[int]:
+        try:
+            return self.slots.index(name)
+        except ValueError:
+            return None
+
+
+def _immutable(value) -> bool:
+    if isinstance(value, tuple):
+        return all(_immutable(v) for v in value)
+    return isinstance(value, IMMUTABLE_LITERALS)
+
+
+def _literal(node: ast.AST) -> tuple[bool, object]:
+    # Only immutable literals count: a list or dict would be one object
+    # shared by every session running the Script
+    try:
+        value = ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return False, None
+    return (True, value) if _immutable(value) else (False, None)
+
+
+def _names(node: ast.AST) -> set[str]:
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+
+def _test(expr: str):
+    # ('load', name) | ('test', name, op, const) | None for anything else
+    try:
+        node = ast.parse(expr, mode='eval').body
+    except SyntaxError:
+        return None
+
+    if isinstance(node, ast.Name):
+        return 'load', node.id
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not) and isinstance(node.operand, ast.Name):
+        return 'test', node.operand.id, 'not_', None
+
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in COMPARE_OPS:
+        op = COMPARE_OPS[type(node.ops[0])]
+        left, right = node.left, node.comparators[0]
+        if isinstance(left, ast.Name):
+            ok, value = _literal(right)
+            if ok:
+                return 'test', left.id, op, value
+        if isinstance(right, ast.Name):
+            ok, value = _literal(left)
+            if ok:
+                return 'test', right.id, MIRROR[op], value
+
+    return None
+
+
+def assign(code: str):
+    # ('set', name, const) | ('set_expr', name, expr) | ('aug', name, op, const) | None
+    try:
+        body = ast.parse(code, mode='exec').body
+    except SyntaxError:
+        return None
+
+    if len(body) != 1:
+        return None
+
+    stmt = body[0]
+    if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name):
+        ok, value = _literal(stmt.value)
+        if ok:
+            return 'set', stmt.targets[0].id, value
+        return 'set_expr', stmt.targets[0].id, ast.unparse(stmt.value)
+
+    if isinstance(stmt, ast.AugAssign) and isinstance(stmt.target, ast.Name) and type(stmt.op) in AUG_OPS:
+        ok, value = _literal(stmt.value)
+        if ok:
+            return 'aug', stmt.target.id, AUG_OPS[type(stmt.op)], value
+
+    return None
+
+
+def _source_names(source) -> set[str]:
+    if not isinstance(source, str):
+        return set()
+    try:
+        return _names(ast.parse(source, mode='exec'))
+    except SyntaxError:
+        return set()
+
+
+def analyze(chunk: Iterable[tuple[IType, tuple]]) -> SymbolTable:
+    used: list[str] = []
+    dynamic: set[str] = set()
+
+    def use(name: str):
+        if name not in used:
+            used.append(name)
+
+    for itype, args in chunk:
+        if itype in (IType.OP_EXPR, IType.OP_EXPR_JUMP_FALSE):
+            form = _test(args[0])
+            if form:
+                use(form[1])
+            else:
+                dynamic |= _source_names(args[0])
+
+        elif itype == IType.EXEC_CODE:
+            form = assign(args[0])
+            if form:
+                use(form[1])
+                if form[0] == 'set_expr':
+                    dynamic |= _source_names(form[2])
+            else:
+                dynamic |= _source_names(args[0])
+
+        elif itype in (IType.ADD_OPTION, IType.EXEC_EXPR_LINE):
+            for arg in args[:2]:
+                dynamic |= _source_names(arg)
+
+    return SymbolTable(tuple(name for name in used if name not in dynamic), frozenset(dynamic))
+
+
+def resolve(chunk: Iterable[tuple[IType, tuple]]) -> tuple[list[I], SymbolTable]:
+    # Rewrites expressions and `$` assignments over slot-resolved names into
+    # slot instructions; the table is declared by a DECLARE_SLOTS prologue,
+    # which shifts no relative jump
+    chunk = list(chunk)
+    table = analyze(chunk)
+    slot = {name: i for i, name in enumerate(table.slots)}
+
+    out = [I(IType.DECLARE_SLOTS, table.slots)]
+    for itype, args in chunk:
+        if itype in (IType.OP_EXPR, IType.OP_EXPR_JUMP_FALSE):
+            form = _test(args[0])
+            if form and form[1] in slot:
+                jump = args[1:] if itype == IType.OP_EXPR_JUMP_FALSE else ()
+                if form[0] == 'load' and not jump:
+                    out.append(I(IType.OP_LOAD_SLOT, (slot[form[1]],)))
+                    continue
+                test = ('truth', None) if form[0] == 'load' else form[2:]
+                out.append(I(IType.OP_TEST_SLOT_JUMP_FALSE if jump else IType.OP_TEST_SLOT,
+                             (slot[form[1]], *test, *jump)))
+                continue
+
+        elif itype == IType.EXEC_CODE:
+            form = assign(args[0])
+            if form and form[1] in slot:
+                kind, name, *rest = form
+                out.append(I({'set': IType.SET_SLOT, 'set_expr': IType.SET_SLOT_EXPR, 'aug': IType.AUG_SLOT}[kind],
+                             (slot[name], *rest)))
+                continue
+
+        out.append(I(itype, tuple(args)))
+
+    return out, table
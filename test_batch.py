@@ -0,0 +1,150 @@
+# %%
+import numpy as np
+import pytest
+from batch import Batch
+from bytecode import ChunkError
+from compiler import Compiler
+from optimizer import optimize
+from tokens import EventType as E, Event
+from vm import link
+
+GUARD = """$ mood = 0
+- 'Guard' 'Halt!' if {hp > 50}
+- 'Guard' {f'You look hurt, {name}.'} if {hp <= 50}
+- 'Guard' 'Who goes there?'
+choice 'Friend' if {not angry}:
+    $ mood += 1
+    - 'Guard' 'Pass.'
+choice 'Foe':
+    $ mood -= 1
+    - 'Guard' 'Begone!'
+choice 'Wait' if {hp > 100}
+- 'Guard' {f'Mood {mood}.'}
+"""
+
+LOOP = """label top
+$ hp -= 30
+- 'Guard' {f'{hp} left'} if {hp > 0 and not angry}
+choice 'Again' if {hp > 0} | goto top
+choice 'Stop'
+"""
+
+SIZE = 40
+
+
+def variables(size: int = SIZE) -> list[dict]:
+    rng = np.random.default_rng(0)
+    return [{'hp': int(hp), 'angry': bool(angry), 'name': f'npc{k}'}
+            for k, (hp, angry) in enumerate(zip(rng.integers(1, 150, size), rng.integers(0, 2, size)))]
+
+
+def choose(member: int, event: Event) -> int:
+    # Differs between sessions, and only ever picks a valid option
+    valid = [idx for idx, (_, ok) in enumerate(event.args) if ok]
+    return valid[member % len(valid)]
+
+
+def sequential(chunk, rows: list[dict]):
+    script = link(chunk)
+    traces, finals = [], []
+    for member, row in enumerate(rows):
+        session = script.session(dict(row))
+        trace = [session.run()]
+        while trace[-1].type is not E.END:
+            if trace[-1].type is E.OPTIONS:
+                session.choose(choose(member, trace[-1]))
+            trace.append(session.run())
+        traces.append(trace)
+        finals.append(session.locals)
+    return traces, finals
+
+
+def batched(chunk, rows: list[dict]):
+    batch = Batch(chunk, len(rows), rows[0])
+    for name in rows[0]:
+        batch.columns[name][:] = [row[name] for row in rows]
+
+    traces = [[] for _ in rows]
+    while not batch.halted:
+        for group in batch.tick():
+            members = group.members.tolist()
+            events = group.events()
+            for member, event in zip(members, events):
+                traces[member].append(event)
+            choices = [choose(member, event) if event.type is E.OPTIONS else -1
+                       for member, event in zip(members, events)]
+            batch.resume(group, choices)
+
+    for member in range(len(rows)):
+        traces[member].append(Event(E.END))
+    return traces, [dict(batch.row(member)) for member in range(len(rows))]
+
+
+@pytest.mark.parametrize('source', (GUARD, LOOP))
+@pytest.mark.parametrize('optimized', (False, True))
+def test_matches_sequential_vm(source, optimized):
+    chunk = Compiler().compile(source)
+    if optimized:
+        chunk, _ = optimize(chunk)
+    rows = variables()
+
+    assert batched(chunk, rows) == sequential(chunk, rows)
+
+
+def test_groups_split_on_conditions():
+    chunk = Compiler().compile(GUARD)
+    batch = Batch(chunk, 4, {'hp': 100, 'angry': False, 'name': 'x'})
+    batch.columns['hp'][:] = [10, 60, 20, 90]
+
+    first = batch.tick()
+    assert sorted(group.members.tolist() for group in first) == [[0, 2], [1, 3]]
+
+
+def test_groups_merge_where_branches_rejoin():
+    chunk = Compiler().compile(GUARD)
+    batch = Batch(chunk, 4, {'hp': 100, 'angry': False, 'name': 'x'})
+    batch.columns['hp'][:] = [10, 60, 20, 90]
+
+    for group in batch.tick():
+        batch.resume(group)
+    # Both halves reach 'Who goes there?' and go on as one group
+    (group,) = batch.tick()
+    assert sorted(group.members.tolist()) == [0, 1, 2, 3]
+    assert group.events() == [Event(E.LINE, ('Guard', 'Who goes there?'))] * 4
+
+
+def test_divergent_choices_split_and_halt_together():
+    chunk = Compiler().compile(GUARD)
+    batch = Batch(chunk, 4, {'hp': 100, 'angry': False, 'name': 'x'})
+    while not batch.halted:
+        for group in batch.tick():
+            batch.resume(group, np.arange(len(group)) % 2 if group.options else None)
+
+    assert [batch.row(member)['mood'] for member in range(4)] == [1, -1, 1, -1]
+    (end,) = batch.groups
+    assert sorted(end.members.tolist()) == [0, 1, 2, 3]
+
+
+def test_invalid_choice_stays_at_menu():
+    chunk = Compiler().compile(GUARD)
+    batch = Batch(chunk, 2, {'hp': 100, 'angry': True, 'name': 'x'})
+    batch.run(max_ticks=3)
+    (menu,) = batch.tick()
+    assert menu.options
+
+    # Option 0 is invalid while angry
+    batch.resume(menu, [0, 1])
+    parked = [group for group in batch.groups if group.ip == menu.ip]
+    assert [group.members.tolist() for group in parked] == [[0]]
+    assert parked[0].events() == menu.events()[:1]
+
+
+def test_slot_chunks_are_rejected():
+    chunk = Compiler(slots=True).compile(GUARD)
+    with pytest.raises(ChunkError, match='compile without slots'):
+        Batch(chunk, 2, {'hp': 100, 'angry': False, 'name': 'x'})
+
+
+# %%
+if __name__ == '__main__':
+    pytest.main([__file__])
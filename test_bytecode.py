@@ -0,0 +1,80 @@
+# %%
+from pathlib import Path
+import pytest
+from bytecode import BIN_MAGIC, ChunkError, MappedProgram, dump, pack, resolve_labels
+from compiler import Compiler
+from tokens import EventType as E
+from vm import LazyHandlers, link
+
+# TestDS jumps to a label it never defines; give it one at the end
+SCRIPT = (Path(__file__).parent / 'TestDS.zds').read_text(encoding='utf-8') + '\nlabel nowhere\n'
+
+# Names TestDS reads, speakers included
+VARIABLES = {'g': 1, 'a': 4, 'b': 4, 'name': 'Bob', 'well': 'Well', 'npc': 'Npc', 'bob': 'Bob', 'bill': 'Bill'}
+
+# Label names whose UTF-8 order differs from their code point order, and
+# lengths that share prefixes, to exercise the binary search
+LABELS = ('a', 'ab', 'abc', 'b', 'z', 'Z', '_', 'é', 'ﬀ', '𝔘', 'x1', 'x10', 'x2')
+
+
+def play(script) -> list:
+    # Event stream of one run, always taking the first valid option
+    session = script.session(dict(VARIABLES))
+    events = [session.run()]
+    while events[-1].type is not E.END:
+        if events[-1].type is E.OPTIONS:
+            session.choose(next((idx for idx, (_, ok) in enumerate(events[-1].args) if ok), 0))
+        events.append(session.run())
+    return events
+
+
+def labelled() -> str:
+    lines = []
+    for k, name in enumerate(LABELS):
+        lines.extend((f'label {name}', f"- bob 'at {k}'"))
+    lines.extend(f'goto {name} if {{False}}' for name in LABELS)
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.mark.parametrize('source', (SCRIPT, labelled()))
+def test_mapped_matches_chunk(tmp_path, source):
+    chunk = Compiler().compile(source)
+    path = tmp_path / 'program.zdsb'
+    dump(chunk, path)
+
+    with MappedProgram(path) as program:
+        assert len(program) == len(chunk)
+        assert list(program) == list(pack(chunk)) == [(itype, tuple(args)) for itype, args in chunk]
+        assert program[-1] == program[len(program) - 1] and program[2:5] == list(program)[2:5]
+
+        labels = resolve_labels(chunk)
+        assert dict(program.labels) == labels
+        for name, addr in labels.items():
+            assert program.labels[name] == addr
+        for name in ('', 'nope', 'a0', 'zz', '￿'):
+            assert name not in program.labels
+
+
+def test_mapped_plays_the_same(tmp_path):
+    chunk = Compiler().compile(SCRIPT)
+    path = tmp_path / 'program.zdsb'
+    dump(chunk, path)
+
+    with MappedProgram(path) as program:
+        script = link(program)
+        assert isinstance(script.handlers, LazyHandlers)
+        assert play(script) == play(link(chunk))
+        # Only the instructions a run reached were bound
+        assert 0 < len(script.handlers) < len(program)
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'program.zdsb'
+    path.write_bytes(BIN_MAGIC[::-1] + bytes(100))
+    with pytest.raises(ChunkError):
+        MappedProgram(path)
+
+
+# %%
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,70 @@
+# %%
+from io import StringIO
+from pathlib import Path
+from compiler import Compiler
+from lexer import tokenize
+from scanner import scan_buffer
+from tokens import InstructionType as IType
+
+SCRIPT = (Path(__file__).parent / 'TestDS.zds').read_text(encoding='utf-8')
+
+SOURCES = (
+    SCRIPT,
+    "$ x = -1 * (2 **\n    3) | goto a\n- a 'b'\n",
+    "- 'x' {(a ==\n    1)}\n$ y = '''a\nb'''\n",
+    "label a\n- bob 'hi' [ 'tag' ] if {met}\nchoice 'go' | goto a\nchoice 'stay'\n",
+)
+
+
+class CountedLines(StringIO):
+    # Counts the lines handed out by readline
+
+    def __init__(self, source: str) -> None:
+        super().__init__(source)
+        self.read = 0
+
+    def readline(self, *args) -> str:
+        line = super().readline(*args)
+        self.read += bool(line)
+        return line
+
+
+def test_compile_from_tokenize():
+    for source in SOURCES:
+        expected = Compiler().compile(scan_buffer(source))
+        assert Compiler().compile(tokenize(StringIO(source))) == expected
+        assert Compiler().compile(tokenize(source)) == expected
+        assert Compiler().compile(StringIO(source)) == expected
+
+
+def test_stream_matches_buffer():
+    for source in SOURCES:
+        assert list(tokenize(source)) == list(scan_buffer(source))
+        assert list(scan_buffer(StringIO(source))) == list(scan_buffer(source))
+
+
+def test_code_sliced_from_stream():
+    code = Compiler().compile(tokenize("$ x = -1 * (2 **\n    3) | goto a\n"))
+    assert code[0] == (IType.EXEC_CODE, ('x = -1 * (2 **\n    3)',))
+
+
+def test_compile_starts_before_source_is_read():
+    log = []
+    lines = CountedLines(SCRIPT)
+
+    class Logged(Compiler):
+
+        def _statement(self):
+            log.append(lines.read)
+            super()._statement()
+
+    Logged().compile(tokenize(lines))
+    assert log[0] < lines.read
+
+
+# %%
+if __name__ == '__main__':
+    test_compile_from_tokenize()
+    test_stream_matches_buffer()
+    test_code_sliced_from_stream()
+    test_compile_starts_before_source_is_read()
@@ -0,0 +1,79 @@
+# %%
+import pytest
+from exprs import UnsafeExpressionError, evaluator, is_constant
+
+NAMESPACE = {'met': False, 'j': 4, 'pclass': 'wizard', 'name': 'Bob', 'items': [1, 2], 'none': None}
+
+# In the closure subset
+CLOSURES = (
+    'met == False', "pclass=='wizard'", 'j==4', 'not met', '-j', '1 < j <= 4', '1 < j < 3',
+    'met or j', 'met and j', 'j and pclass', 'none is None', 'j in items', 'j not in items',
+    'name.lower', "f'{name} has {j:>3} {pclass!r}'", 'len', 'True', "'x'",
+)
+
+# Outside it, so evaluated by the eval fallback
+FALLBACKS = ('j + 1', 'items[0]', 'len(items)', "name.lower()", '[x * 2 for x in items]', 'j if met else -j',
+             "f'{j + 1}'")
+
+# Raise the same way on either path
+RAISING = ('missing', 'missing == 1', 'j / 0', "name.nothing", 'items[5]')
+
+
+def reference(src: str, namespace: dict):
+    try:
+        return eval(src, {}, dict(namespace))
+    except Exception as e:  # pylint: disable=broad-except
+        return type(e)
+
+
+def evaluate(src: str, namespace: dict):
+    try:
+        return evaluator(src)(dict(namespace))
+    except Exception as e:  # pylint: disable=broad-except
+        return type(e)
+
+
+def test_closures_match_eval():
+    for src in CLOSURES + RAISING:
+        assert evaluate(src, NAMESPACE) == reference(src, NAMESPACE), src
+
+
+def test_fallback_matches_eval():
+    for src in FALLBACKS:
+        assert evaluate(src, NAMESPACE) == reference(src, NAMESPACE), src
+
+
+def test_safe_takes_only_the_subset():
+    for src in CLOSURES:
+        evaluator(src, safe=True)
+    for src in FALLBACKS + ('name._private',):
+        with pytest.raises(UnsafeExpressionError):
+            evaluator(src, safe=True)
+
+
+def test_constants_fold():
+    for src, value in (('True', True), ('-1', -1), ('2 ** 10', 1024), ("'a' * 2", 'aa')):
+        fn = evaluator(src)
+        assert is_constant(fn) and fn.const == value, src
+
+    assert not is_constant(evaluator('[1, 2]'))
+
+
+def test_name_free_expression_that_raises_loads():
+    # Fails when run, as eval would, not when the script is loaded
+    for src, error in (('1 / 0', ZeroDivisionError), ("int('x')", ValueError), ('[][0]', IndexError)):
+        fn = evaluator(src)
+        assert not is_constant(fn)
+        with pytest.raises(error):
+            fn({})
+
+
+def test_fallback_sees_only_builtins_and_namespace():
+    assert evaluator('len(items)')(NAMESPACE) == 2
+    with pytest.raises(NameError):
+        evaluator('evaluator(j)')(NAMESPACE)
+
+
+# %%
+if __name__ == '__main__':
+    pytest.main([__file__])
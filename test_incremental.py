@@ -0,0 +1,85 @@
+# %%
+import random
+from compiler import Compiler
+from incremental import LiveScript
+from scanner import scan_buffer
+from tokens import TokenType as T
+
+
+# Bits of text that open or close brackets, strings, blocks and menus
+SNIPPETS = ("x", " ", "\n", "    ", "- bob 'hi'\n", "choice 'a'\n", "choice 'b' | goto q\n", "{a ==", "}", "'",
+            ":\n    - 'q'\n", "(", ")", "label z\n", "#c\n", "    - 'in'\n")
+
+# Tokens the statement split moves between neighbours without changing the
+# program
+LAYOUT = {T.NEWLINE.value, T.INDENT.value, T.DEDENT.value, T.END.value}
+
+
+def full(source: str):
+    return Compiler().compile(scan_buffer(source))
+
+
+def script(sections: int) -> str:
+    with open('TestDS.zds', 'r', encoding='utf-8') as f:
+        section = f.read().rstrip('\n') + '\n\n'
+    return ''.join(f'label s{i}\n' + section for i in range(sections))
+
+
+def check_positions(live: LiveScript):
+    whole = scan_buffer(live.source)
+    expected = {whole.starts[i]: whole.position(i) for i in range(len(whole)) if whole.types[i] not in LAYOUT}
+    for start, buffer in zip(live.starts, live.buffers):
+        for i in range(len(buffer)):
+            if buffer.types[i] not in LAYOUT:
+                assert buffer.position(i) == expected[start + buffer.starts[i]]
+
+
+def fuzz(seed: int, sections: int, edits: int):
+    # Random edits must leave the same program, or raise the same way, as
+    # compiling the edited source from scratch
+    rand = random.Random(seed)
+    live = LiveScript(script(sections))
+    for _ in range(edits):
+        source = live.source
+        start = rand.randrange(len(source) + 1)
+        end = min(len(source), start + rand.choice((0, 0, 1, 3, 10)))
+        if rand.random() < .5:
+            # Edits at the start of a line are where statements split
+            start = source.rfind('\n', 0, start) + 1
+        text = rand.choice(SNIPPETS) if rand.random() < .8 else ''
+
+        try:
+            expected = full(source[:start] + text + source[end:])
+        except Exception:  # pylint: disable=broad-except
+            try:
+                live.edit(start, end, text)
+            except Exception:  # pylint: disable=broad-except
+                assert live.source == source
+                continue
+            raise AssertionError(f'edit {start}:{end} {text!r} should not compile')
+
+        live.edit(start, end, text)
+        assert live.instructions == expected
+        check_positions(live)
+
+
+def test_fresh():
+    source = script(3)
+    assert LiveScript(source).instructions == full(source)
+
+
+def test_edits():
+    for seed in range(4):
+        fuzz(seed, 1, 500)
+
+
+def test_edits_between_sections():
+    for seed in range(2):
+        fuzz(seed, 10, 300)
+
+
+# %%
+if __name__ == '__main__':
+    test_fresh()
+    test_edits()
+    test_edits_between_sections()
@@ -0,0 +1,108 @@
+# %%
+import random
+from collections import Counter, defaultdict
+from pathlib import Path
+from compiler import Compiler
+from optimizer import optimize
+from tokens import EventType as E
+from vm import link
+
+# TestDS jumps to a label it never defines; give it one at the end
+SCRIPT = (Path(__file__).parent / 'TestDS.zds').read_text(encoding='utf-8') + '\nlabel nowhere\n'
+
+CONDITIONS = ('True', 'False', '1', '0', "'a' == 'a'", 'x > 1', 'x', 'not x', 'x == 2 or False')
+
+# Events compared per run; generated gotos may loop forever
+LIMIT = 200
+
+
+def play(chunk, seed: int) -> list:
+    # Event stream of one run, answering each menu with a seeded valid pick
+    rand = random.Random(seed)
+    session = link(chunk).session(defaultdict(int))
+    events = []
+    while len(events) < LIMIT:
+        try:
+            event = session.run()
+        except Exception as e:  # pylint: disable=broad-except
+            events.append(repr(e))
+            break
+        events.append(event)
+        if event.type is E.END:
+            break
+        if event.type is E.OPTIONS:
+            session.choose(rand.choice([idx for idx, (_, ok) in enumerate(event.args) if ok] or [0]))
+    return events
+
+
+def generate(rand: random.Random, labels: int = 3) -> str:
+    # A small script over one variable, with constant conditions for the
+    # optimizer to fold, jumps to thread and dead code after gotos. Gotos
+    # only go forward, so a run can never spin without an event.
+    names = [f'l{k}' for k in range(labels)]
+    lines = []
+
+    def target() -> str:
+        return rand.choice(names)
+
+    def condition() -> str:
+        return f' if {{{rand.choice(CONDITIONS)}}}' if rand.random() < .5 else ''
+
+    for n in range(rand.randrange(4, 12)):
+        kind = rand.randrange(6)
+        if kind == 0:
+            lines.append(f"- bob 'line {n}'{condition()}")
+        elif kind == 1:
+            lines.append(rand.choice(('$ x = 0', '$ x = 2', '$ x += 1', '$ x -= 1')))
+        elif kind == 2 and len(names) > 1:
+            lines.append(f'label {names.pop(0)}')
+        elif kind == 3:
+            lines.append(f'goto {target()}{condition()}')
+        elif kind == 4:
+            for c in range(rand.randrange(1, 4)):
+                lines.append(f"choice 'c{n}.{c}'{condition()}:")
+                lines.append(f"    - amy 'picked {n}.{c}'")
+                if rand.random() < .3:
+                    lines.append(f'    goto {target()}')
+        else:
+            lines.append(f'- amy{condition()}:')
+            lines.extend(f"    'block {n}.{k}'" for k in range(rand.randrange(1, 3)))
+
+    lines.extend(f'label {name}' for name in names)
+    return '\n'.join(lines) + '\n'
+
+
+def check(source: str, runs: int = 5):
+    chunk = Compiler().compile(source)
+    optimized, _ = optimize(chunk)
+    for seed in range(runs):
+        assert play(optimized, seed) == play(chunk, seed), source
+
+
+def test_testds():
+    check(SCRIPT, runs=20)
+
+
+def test_generated():
+    rand = random.Random(0)
+    for _ in range(200):
+        check(generate(rand))
+
+
+def test_rewrites_happen():
+    # The generated scripts exercise every pass, so the comparison above
+    # covers more than an unchanged chunk
+    rand = random.Random(0)
+    report = Counter()
+    for _ in range(200):
+        report.update(optimize(Compiler().compile(generate(rand)))[1])
+    for name in ('constant conditions', 'jumps threaded', 'dead instructions removed', 'expr + jump_false fused',
+                 'expr + expr + line fused'):
+        assert report[name], name
+
+
+# %%
+if __name__ == '__main__':
+    test_testds()
+    test_generated()
+    test_rewrites_happen()
@@ -0,0 +1,134 @@
+# %%
+import pytest
+import astnodes as N
+import dlgtest as T
+from dlg import player as P
+from interpreter import Interpreter, Tree, load_tree
+from sinks import ListSink
+from treecompile import CompiledInterpreter, CompiledTree, load_compiled
+
+
+def tree() -> N.BlockNode:
+    stay, leave = N.OptionNode('Stay'), N.OptionNode('Leave', condition='n > 1')
+    stay.add_child(N.CodeNode('n += 1'))
+    stay.add_child(N.LineNode('"Bob"', 'f"Staying {n}"'))
+    menu = N.OptionGroup()
+    menu.add_child(stay)
+    menu.add_child(leave)
+    return N.BlockNode('', [N.CodeNode('n = 0'), N.LineNode('"Bob"', '"Hello"', tags=['calm']), menu,
+                            N.LineNode('"Bob"', 'f"n is {n}"')])
+
+
+def step(it: Interpreter, choice: int):
+    if it.frames or it.options:
+        it.next(choice)
+
+
+def test_tree_sessions_share_one_tree():
+    backends = ((Interpreter, load_tree, Tree), (CompiledInterpreter, load_compiled, CompiledTree))
+    for interpreter, load, shared in backends:
+        alone = interpreter(tree(), ListSink())
+        alone.run()
+        while alone.frames or alone.options:
+            alone.next(0)
+
+        script = load(tree())
+        assert isinstance(script, shared)
+        sessions = [script.session(ListSink()) for _ in range(3)]
+        assert all(session.tree is script for session in sessions)
+        assert not hasattr(sessions[0], '__dict__')
+
+        # Interleaved, each session keeps its own place and variables
+        for session in sessions:
+            session.run()
+        while any(session.frames or session.options for session in sessions):
+            for k, session in enumerate(sessions):
+                step(session, 0 if k else 1)
+
+        assert sessions[1].sink.events == sessions[2].sink.events == alone.sink.events
+        assert sessions[1].locals == {'n': 1}
+        assert sessions[0].locals == {'n': 0}
+
+
+INSTRUCTIONS = [
+    P.Instruction(P.I.SECTION, ('START',)),
+    P.Instruction(P.I.JUMP_IF_FALSE, ('met', 1)),
+    P.Instruction(P.I.LINE, ('"Bob"', '"Again, {name}?"')),
+    P.Instruction(P.I.JUMP_IF_FALSE, ('not met', 2)),
+    P.Instruction(P.I.LINE, ('"Bob"', '"Hello."')),
+    P.Instruction(P.I.SCRIPT, ('met = True',)),
+    P.Instruction(P.I.SET_LOCAL, ('times', 'times + 1')),
+    P.Instruction(P.I.JUMP_IF_FALSE, ('times < 2', 1)),
+    P.Instruction(P.I.GOTO, ('START',)),
+    P.Instruction(P.I.LINE, ('name', '"Bye."')),
+]
+
+
+def test_dlg_players_share_one_script():
+    script = P.load(INSTRUCTIONS)
+    context = {'name': 'Bill', 'times': 0, 'met': False}
+    players = [script.session(context, ListSink()) for _ in range(2)]
+    for player in players:
+        player.play()
+
+    alone = P.DlgPlayer(INSTRUCTIONS, context, ListSink())
+    alone.play()
+    assert players[0].sink.events == players[1].sink.events == alone.sink.events
+    assert [event.args for event in alone.sink.events[:-1]] == [('Bob', 'Hello.'), ('Bob', 'Again, Bill?'),
+                                                                 ('Bill', 'Bye.')]
+    assert all(player.program is script for player in players)
+    assert context == {'name': 'Bill', 'times': 0, 'met': False}
+
+
+class Replies(ListSink):
+    # Answers each menu with the next reply given
+
+    def __init__(self, *replies: str) -> None:
+        super().__init__()
+        self.replies = list(replies)
+
+    def respond(self, event):
+        return self.replies.pop(0) if event.type is T.E.OPTIONS else None
+
+
+def test_dlgtest_players_share_one_script():
+    # A repeated label jumps to its first occurrence
+    nodes = [T.DlgLabel('Start'), T.DlgLine('Bob', 'Hello!'),
+             T.DlgChoices([T.DlgChoice('Restart', target='Start'), T.DlgChoice('Continue')]),
+             T.DlgLine('Bob', 'Goodbye.'), T.DlgLabel('Start'), T.DlgLine('Me', 'Bye.')]
+    script = T.load(nodes)
+    assert script.labels == {'Start': 0}
+
+    again, once = script.session(Replies('1', '2')), script.session(Replies('2'))
+    again.play()
+    once.play()
+    lines = [('Bob', 'Hello!'), ('Bob', 'Goodbye.'), ('Me', 'Bye.')]
+    assert [event.args for event in once.sink.events if event.type is T.E.LINE] == lines
+    assert [event.args for event in again.sink.events if event.type is T.E.LINE] == lines[:1] + lines
+    assert all(player.script is script for player in (again, once))
+    assert T.DlgPlayer(nodes).nodes == script.nodes
+
+
+def test_dlgtest_conditions_see_module_globals(monkeypatch):
+    monkeypatch.setattr(T, 'met', False, raising=False)
+    line = T.DlgLine('Bob', 'Hi again.', condition='met')
+    assert not line.is_valid()
+    assert line.is_valid(local_context={'met': True})
+    assert line.is_valid({'met': True})
+
+    player = T.DlgPlayer([line], ListSink())
+    player.play()
+    assert not player.conditions.value('met')
+
+    # Session writes shadow the module global without changing it
+    player.conditions.exec('met = True')
+    assert player.conditions.value('met') and T.met is False
+    monkeypatch.setattr(T, 'met', True)
+    again = T.DlgPlayer([line], ListSink())
+    again.play()
+    assert [event.args for event in again.sink.events] == [('Bob', 'Hi again.'), ()]
+
+
+# %%
+if __name__ == '__main__':
+    pytest.main([__file__])
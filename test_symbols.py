@@ -0,0 +1,109 @@
+# %%
+from pathlib import Path
+from compiler import Compiler
+from symbols import analyze, assign, resolve
+from tokens import EventType as E, InstructionType as IType
+from vm import link
+
+# TestDS jumps to a label it never defines; give it one at the end
+SCRIPT = (Path(__file__).parent / 'TestDS.zds').read_text(encoding='utf-8') + '\nlabel nowhere\n'
+
+SCRIPTS = (
+    "$ n = 1\n$ n += 2\n- 'a' {n}\n- 'b' 'big' if {2 < n}\n- 'c' 'none' if {n is None}\n$ n *= 3\n- 'd' {n}\n",
+    "$ t = (1, 2)\n$ t += (3,)\n$ s = 'x'\n$ s += 'y'\n- 'a' {t}\n- 'b' {s}\n$ m = len(t) * 2\n- 'c' {m}\n",
+    "$ met = False\n- 'a' 'hi' if {not met}\n$ met = True\nchoice 'x' if {met}:\n    $ k = 1\n"
+    "choice 'y' if {met == False}:\n    $ k = 2\n- 'b' {k}\n",
+    "$ inv = []\n$ inv += [1]\n- 'a' {inv}\n$ d = {'k': 1}\n- 'b' {d['k']}\n",
+    SCRIPT,
+)
+
+# Names TestDS reads, speakers included
+VARIABLES = {'g': 1, 'a': 4, 'b': 4, 'name': 'Bob', 'well': 'Well', 'npc': 'Npc', 'bob': 'Bob', 'bill': 'Bill'}
+
+
+def play(chunk, variables: dict = None, defaults: dict = None):
+    # Event stream of one run, always taking the first valid option, and
+    # the variables it ends with
+    session = link(chunk).session(variables, defaults)
+    events = []
+    while not events or events[-1].type is not E.END:
+        try:
+            event = session.run()
+        except NameError as e:
+            events.append(repr(e))
+            break
+        events.append(event)
+        if event.type is E.OPTIONS:
+            session.choose(next((idx for idx, (_, ok) in enumerate(event.args) if ok), 0))
+
+    names = set(session.script.slots) | set(session.locals)
+    finals = {}
+    for name in names:
+        try:
+            finals[name] = session.variable(name)
+        except KeyError:
+            pass
+    return events, finals
+
+
+def test_slots_play_the_same():
+    for source in SCRIPTS:
+        plain = Compiler().compile(source)
+        slotted = Compiler(slots=True).compile(source)
+        assert play(slotted, dict(VARIABLES)) == play(plain, dict(VARIABLES)), source
+
+
+def test_mutable_literals_are_built_per_session():
+    # A list or dict literal is rebuilt by each assignment rather than baked
+    # into the shared instruction
+    for code, expr in (('inv = []', '[]'), ("d = {'k': 1}", "{'k': 1}"), ('t = (1, [2])', '(1, [2])')):
+        assert assign(code) == ('set_expr', code.split(' = ')[0], expr)
+
+    assert assign('inv += [1]') is None
+    assert assign('t = (1, 2)') == ('set', 't', (1, 2))
+    chunk, table = resolve(Compiler().compile("$ inv = []\n- 'a' {inv}\n"))
+    assert table.slots == ('inv',) and (IType.SET_SLOT_EXPR, (0, '[]')) in chunk
+
+
+def test_sessions_do_not_share_literals():
+    script = link(Compiler(slots=True).compile("$ inv = []\n$ inv += [1]\n$ t = (1,)\n$ t += (2,)\n- 'a' {inv}\n"))
+    for _ in range(3):
+        session = script.session()
+        assert session.run().args == ('a', [1])
+        assert session.variable('t') == (1, 2)
+
+
+def test_mutable_defaults_are_copied_per_session():
+    chunk = Compiler(slots=True).compile("$ inv += [1]\n- 'a' {inv}\n- 'b' {n}\n")
+    defaults = {'inv': [0], 'n': 5}
+    for _ in range(3):
+        assert play(chunk, defaults=defaults)[0][:2] == [(E.LINE, ('a', [0, 1])), (E.LINE, ('b', 5))]
+    assert defaults == {'inv': [0], 'n': 5}
+
+
+def test_in_place_operators_rebind():
+    # AUG_SLOT applies the plain operator, so a value shared with another
+    # name or session is never mutated through the slot
+    assert assign('n += 2') == ('aug', 'n', 'add', 2)
+    assert assign("s += 'x'") == ('aug', 's', 'add', 'x')
+
+    chunk = Compiler(slots=True).compile("$ t = (1,)\n$ t += (2,)\n$ t *= 2\n- 'a' {t}\n")
+    assert [args for itype, args in chunk if itype == IType.AUG_SLOT] == [(0, 'add', (2,)), (0, 'mul', 2)]
+    script = link(chunk)
+    assert script.session().run().args == script.session().run().args == ('a', (1, 2, 1, 2))
+
+
+def test_unanalyzable_code_keeps_names_dynamic():
+    table = analyze(Compiler().compile("$ n = 1\n$ m = n * 2\n$ k = 0\n$ print(k)\n- 'a' {j}\n"))
+    assert table.slots == ('m', 'j')
+    assert table.dynamic == {'n', 'k', 'print'}
+
+
+# %%
+if __name__ == '__main__':
+    test_slots_play_the_same()
+    test_mutable_literals_are_built_per_session()
+    test_sessions_do_not_share_literals()
+    test_mutable_defaults_are_copied_per_session()
+    test_in_place_operators_rebind()
+    test_unanalyzable_code_keeps_names_dynamic()
@@ -31,6 +31,17 @@ class InstructionType(Enum):
     EXEC_TAGS = auto()
     ADD_OPTION = auto()
     EXEC_OPTIONS = auto()
+    # Superinstructions produced by optimizer.optimize
+    OP_EXPR_JUMP_FALSE = auto()
+    EXEC_EXPR_LINE = auto()
+    # Slot-resolved variable access produced by symbols.resolve
+    DECLARE_SLOTS = auto()
+    OP_LOAD_SLOT = auto()
+    OP_TEST_SLOT = auto()
+    OP_TEST_SLOT_JUMP_FALSE = auto()
+    SET_SLOT = auto()
+    SET_SLOT_EXPR = auto()
+    AUG_SLOT = auto()
 
 
 class TokenTypeOld(Enum):
@@ -68,10 +79,12 @@ class TokenType(Enum):
     OPERATOR = auto()
     STATEMENT = auto()
     NAME = auto()
+    EXPR = auto()
     INDENT = auto()
     DEDENT = auto()
     NEWLINE = auto()
     END = auto()
+    EMPTY = auto()
     UNKNOWN = auto()
 
 class Token(NamedTuple):  # pylint: disable=inherit-non-class
@@ -83,3 +96,15 @@ class Token(NamedTuple):  # pylint: disable=inherit-non-class
 class Instruction(NamedTuple): # pylint: disable=inherit-non-class
     type: InstructionType
     args: tuple[Any, ...] = ()
+
+
+class EventType(Enum):
+    LINE = auto()
+    OPTIONS = auto()
+    TAGS = auto()
+    END = auto()
+
+
+class Event(NamedTuple):  # pylint: disable=inherit-non-class
+    type: EventType
+    args: tuple[Any, ...] = ()
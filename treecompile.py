@@ -0,0 +1,156 @@
+# %%
+from typing import Callable, NamedTuple, Union
+import astnodes as N
+from exprs import evaluator, is_constant, template
+from interpreter import Interpreter, validate_tree
+from sinks import EventSink
+
+# Each node compiles once into op(interpreter), with its condition, speaker,
+# text and tags already compiled. Ops replace nodes on the frame stack, so
+# stepping works exactly as in Interpreter.
+Op = Callable[[Interpreter], None]
+
+
+class CompiledOption(NamedTuple):  # pylint: disable=inherit-non-class
+    # Read by Interpreter.optionsview and next() in place of an OptionNode
+    text: str
+    tags: list[str]
+    condition: str
+    children: tuple[Op, ...]
+
+
+def _guard(condition: str, op: Op) -> Op:
+    test = evaluator(condition)
+    if is_constant(test):
+        # Always-true checks disappear; always-false nodes do nothing
+        return op if test.const else _skip
+
+    def guarded(it: Interpreter):
+        if test(it.locals):
+            op(it)
+
+    return guarded
+
+
+def _skip(it: Interpreter):
+    pass
+
+
+def compile_tree(root: N.AstNode) -> Op:
+    ops: dict[int, Op] = {}
+
+    def compile_node(node: N.AstNode) -> Op:
+        if id(node) in ops:
+            return ops[id(node)]
+
+        # Registered before the children are compiled, so cyclic trees
+        # terminate; the op reads its children list only when run
+        children: list = []
+        ops[id(node)] = _guard(node.condition, _compile(node, children))
+
+        if isinstance(node, N.BlockNode):
+            children.extend(compile_node(child) for child in node.children)
+        elif isinstance(node, N.OptionGroup):
+            children.extend(CompiledOption(option.text, option.tags, option.condition,
+                                           tuple(compile_node(child) for child in option.children))
+                            for option in node.children)
+
+        return ops[id(node)]
+
+    return compile_node(root)
+
+
+def _compile(node: N.AstNode, children: list) -> Op:
+    if isinstance(node, N.CodeNode):
+        return _code(node)
+    if isinstance(node, N.LineNode):
+        return _line(node)
+    if isinstance(node, N.BlockNode):
+        return _block(children)
+    if isinstance(node, N.OptionGroup):
+        return _options(children)
+    return _unsupported(node)
+
+
+def _code(node: N.CodeNode) -> Op:
+    code = node.code
+
+    def op(it: Interpreter):
+        it.conditions.exec(code)
+
+    return op
+
+
+def _line(node: N.LineNode) -> Op:
+    speaker, text = evaluator(node.speaker), evaluator(node.text)
+    tags = [template(tag) for tag in node.tags]
+
+    def op(it: Interpreter):
+        loc = it.locals
+        it.wait = True
+        dialog = it.dialog
+        dialog.label = speaker(loc)
+        dialog.text = text(loc)
+        dialog.tags = [tag(loc) for tag in tags]
+        it._emit_line()
+
+    return op
+
+
+def _block(children: list[Op]) -> Op:
+    def op(it: Interpreter):
+        it._push(children)
+        while not it.wait:
+            child = it._pop()
+            if child is None:
+                break
+            child(it)
+
+    return op
+
+
+def _options(options: list[CompiledOption]) -> Op:
+    def op(it: Interpreter):
+        it.options.extend(options)
+        it._emit_options()
+
+    return op
+
+
+def _unsupported(node: N.AstNode) -> Op:
+    def op(it: Interpreter):
+        raise NotImplementedError(node)
+
+    return op
+
+
+class CompiledTree(NamedTuple):  # pylint: disable=inherit-non-class
+    # Tree compiled once by compile_tree, shared by every CompiledInterpreter
+    root: N.AstNode
+    program: Op
+
+    def session(self, sink: EventSink = None) -> 'CompiledInterpreter':
+        return CompiledInterpreter(self, sink)
+
+
+def load_compiled(root: N.AstNode) -> CompiledTree:
+    validate_tree(root)
+    return CompiledTree(root, compile_tree(root))
+
+
+class CompiledInterpreter(Interpreter):
+    # Interpreter running a tree compiled by compile_tree: no per-node
+    # dispatch, and conditions are never re-parsed or re-checked when
+    # constant
+    __slots__ = ()
+
+    def __init__(self, tree: Union[CompiledTree, N.AstNode], sink: EventSink = None) -> None:
+        if isinstance(tree, N.AstNode):
+            tree = load_compiled(tree)
+        super().__init__(tree, sink)
+
+    def _start(self) -> list[list]:
+        return [[(self.tree.program,), 0]]
+
+    def execute(self, op: Op):
+        op(self)